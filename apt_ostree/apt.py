@@ -12,6 +12,8 @@ import sys
 
 import apt
 
+from apt_ostree.archives import ArchiveCache
+from apt_ostree.lists import ListsCache
 from apt_ostree.utils import run_sandbox_command
 
 
@@ -19,6 +21,8 @@ class Apt:
     def __init__(self, state):
         self.logging = logging.getLogger(__name__)
         self.state = state
+        self.archives = ArchiveCache(self.state)
+        self.lists = ListsCache(self.state)
 
     def cache(self, rootfs):
         try:
@@ -33,7 +37,22 @@ class Apt:
         return cache[package]
 
     def apt_update(self, rootfs):
-        """Run apt-get update."""
+        """Run apt-get update.
+
+        Lists are kept in the workspace for each sources configuration.
+        Lists younger than the configured max age are reused without
+        running apt-get update. Older lists are revalidated, which only
+        fetches what changed, and are still used if that fails.
+        """
+        key = self.lists.key(rootfs)
+        age = self.lists.age(key)
+        if age is not None:
+            self.lists.restore(key, rootfs)
+            if age < self.lists.max_age:
+                self.logging.info(
+                    f"Using package lists from {int(age)}s ago.")
+                return None
+
         self.logging.info("Running apt-update")
         r = run_sandbox_command(
             ["apt-get", "update", "-y"],
@@ -41,27 +60,98 @@ class Apt:
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
         if r.returncode != 0:
-            self.logging.error("Failed to run apt-get update.")
+            if age is not None:
+                self.logging.warning(
+                    "Failed to run apt-get update, using package lists "
+                    f"from {int(age)}s ago.")
+            else:
+                self.logging.error("Failed to run apt-get update.")
+        else:
+            self.lists.save(key, rootfs)
         return r
 
-    def apt_install(self, cache, packages, rootfs):
-        """Run apt-get install."""
+    def apt_install(self, cache, packages, rootfs, offline=False):
+        """Run apt-get install.
+
+        All packages are installed in a single apt-get run so dependency
+        resolution, dpkg database loading and triggers happen once. With
+        offline set, apt only uses archives that were already prefetched.
+        """
         env = os.environ.copy()
         env["DEBIAN_FRONTEND"] = "noninteractive"
+        install = []
         for package in packages:
             version = self.get_version(cache, package)
             pkg = self.apt_package(cache, package)
             if not pkg.is_installed:
                 self.logging.info(f"Installing {package} ({version}).")
+                install.append(package)
             else:
                 self.logging.info(
                     f"Skipping {package} ({version}), already installed.")
-            cmd = ["apt-get", "-y", "install", package]
-            r = run_sandbox_command(cmd, rootfs, env=env,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            if r.returncode != 0:
-                self.logging.error("Failed to run apt-get install")
+        if len(install) == 0:
+            return None
+
+        for package in install:
+            self.apt_package(cache, package).mark_install()
+        changes = cache.get_changes()
+
+        before = self.archives.snapshot()
+        cmd = ["apt-get", "-y", "install"]
+        if offline:
+            cmd += ["--no-download"]
+        cmd += install
+        r = run_sandbox_command(cmd, rootfs, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                check=False,
+                                binds=self.archives.bind_args())
+        self.archives.record(before, changes)
+
+        # Report the outcome for each package from the updated
+        # dpkg database.
+        cache.open()
+        for package in install:
+            pkg = self.apt_package(cache, package)
+            if pkg.is_installed:
+                self.logging.info(
+                    f"Installed {package} ({pkg.installed.version}).")
+            else:
+                self.logging.error(f"Failed to install {package}.")
+        if r.returncode != 0:
+            # Never commit a partly installed tree.
+            self.logging.error("Failed to run apt-get install")
+            self.logging.error(r.stderr.decode("utf-8"))
+            sys.exit(1)
+        return r
+
+    def apt_transaction(self, cache, install, remove, rootfs,
+                        offline=False):
+        """Install and remove packages in a single apt-get run."""
+        env = os.environ.copy()
+        env["DEBIAN_FRONTEND"] = "noninteractive"
+        for package in install:
+            self.apt_package(cache, package).mark_install()
+        for package in remove:
+            self.apt_package(cache, package).mark_delete()
+        changes = cache.get_changes()
+
+        before = self.archives.snapshot()
+        cmd = ["apt-get", "-y", "install"]
+        if offline:
+            cmd += ["--no-download"]
+        cmd += install
+        cmd += [f"{package}-" for package in remove]
+        r = run_sandbox_command(cmd, rootfs, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                check=False,
+                                binds=self.archives.bind_args())
+        self.archives.record(before, changes)
+        if r.returncode != 0:
+            self.logging.error("Failed to run apt-get install")
+            self.logging.error(r.stderr.decode("utf-8"))
+            sys.exit(1)
         return r
 
     def apt_list(self, rootfs, action):
@@ -72,11 +162,17 @@ class Apt:
             stdout=subprocess.PIPE,
             stderr=subprocess.DEVNULL)
 
-    def apt_upgrade(self, rootfs):
+    def apt_upgrade(self, rootfs, changes=None, offline=False):
         """Run apt-get upgrade."""
+        cmd = ["apt-get", "upgrade"]
+        if offline:
+            cmd += ["--no-download"]
+        before = self.archives.snapshot()
         r = run_sandbox_command(
-            ["apt-get", "upgrade"],
-            rootfs)
+            cmd,
+            rootfs,
+            binds=self.archives.bind_args())
+        self.archives.record(before, changes)
         if r.returncode != 0:
             self.logging.error("Failed to run apt-get upgrade.")
         return r
@@ -86,7 +182,8 @@ class Apt:
         cmd = ["apt-get", "remove"]
         if packages:
             cmd += packages
-        r = run_sandbox_command(cmd, rootfs)
+        r = run_sandbox_command(cmd, rootfs,
+                                binds=self.archives.bind_args())
         if r.returncode != 0:
             self.logging.error("Failed to run apt-get remove.")
         return r
@@ -112,26 +209,32 @@ class Apt:
                 pkgs.add(pkg.name)
         return pkgs
 
-    def get_dependencies(self, cache, packages, deps, predeps, all_deps):
-        """Get installed versions."""
-        for pkg in packages:
-            deps = self._get_dependencies(
-                cache, self.apt_package(cache, pkg), deps, "Depends")
-            predeps = self._get_dependencies(
-                cache, self.apt_package(cache, pkg), deps, "PreDepends")
-        all_deps.update(deps, predeps)
-        all_deps = self.check_valid_packages(cache, list(all_deps))
-        return all_deps
-
-    def _get_dependencies(self, cache, pkg, deps, key="Depends"):
-        """Parse the individual dependencies."""
-        candver = cache._depcache.get_candidate_ver(pkg._pkg)
-        if candver is None:
-            return deps
-        dependslist = candver.depends_list
-        if key in dependslist:
-            for depVerList in dependslist[key]:
-                for dep in depVerList:
-                    if dep.target_pkg.name in cache:
-                        deps.add(dep.target_pkg.name)
-        return deps
+    def resolve(self, cache, packages):
+        """Mark packages for installation and read back the install set.
+
+        The depcache resolves the full transitive set in one pass, so no
+        extra apt runs are needed. Returns a dict with the version of
+        every package that would be installed or upgraded, and the
+        download and installed size of the change in bytes.
+        """
+        for package in packages:
+            self.apt_package(cache, package).mark_install()
+        if cache.broken_count > 0:
+            self.logging.error(
+                f"Unable to resolve dependencies for: {', '.join(packages)}")
+            sys.exit(1)
+
+        versions = {}
+        for pkg in cache.get_changes():
+            if pkg.marked_install or pkg.marked_upgrade:
+                versions[pkg.name] = pkg.candidate.version
+        return {
+            "packages": versions,
+            "download_size": cache.required_download,
+            "installed_size": cache.required_space,
+        }
+
+    def get_dependencies(self, cache, packages):
+        """Get the packages pulled in by installing packages."""
+        resolved = self.resolve(cache, packages)
+        return sorted(set(resolved["packages"]) - set(packages))
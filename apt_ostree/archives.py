@@ -0,0 +1,352 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import urllib.request
+
+import apt_pkg
+
+from apt_ostree.utils import get_cache_dir
+
+
+class ArchiveCache:
+    """Downloaded .deb archives shared by every sandbox.
+
+    Archives are stored in <workspace>/cache/archives-sha256 under the
+    sha256 of their content from the Packages index, so packages rebuilt
+    without a version change do not collide. apt looks for archives by
+    package, version and architecture, so the archives a run needs are
+    hardlinked under those names into <workspace>/cache/archives-names.
+    apt locks its archives directory for the whole run, so each process
+    gets a directory of its own in <workspace>/cache/archives, filled
+    with links to every name. That directory is bind-mounted over
+    /var/cache/apt/archives and never committed into a tree. Archives
+    apt downloads itself are added to the store after the run.
+    """
+
+    def __init__(self, state):
+        self.logging = logging.getLogger(__name__)
+        self.state = state
+        self.max_size = self.state.archive_cache_size
+        self.cachedir = None
+        self.objects = None
+        self.names = None
+        self.stats_file = None
+        # Names already accounted by prefetch().
+        self.prefetched = set()
+        self._lock = None
+        if self.enabled():
+            runs = get_cache_dir(self.state, "archives")
+            self.objects = get_cache_dir(self.state, "archives-sha256")
+            self.names = get_cache_dir(self.state, "archives-names")
+            self.stats_file = runs.with_name("archives.json")
+            self._remove_stale(runs)
+            self.cachedir = self._open_run(runs)
+
+    def enabled(self):
+        """The cache is disabled when its size cap is 0."""
+        return self.max_size > 0
+
+    def _open_run(self, runs):
+        """Create the archives directory of this process and lock it.
+
+        The lock is held until close() or the process exits, and tells
+        other processes the directory is in use. The directory is only
+        given its final name once locked.
+        """
+        path = pathlib.Path(tempfile.mkdtemp(prefix="new-", dir=runs))
+        # apt downloads as the _apt user, which must reach partial/.
+        os.chmod(path, 0o755)
+        path.joinpath("partial").mkdir()
+        self._lock = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        for name in self.names.glob("*.deb"):
+            try:
+                os.link(name, path.joinpath(name.name))
+            except FileNotFoundError:
+                # Evicted by a concurrent run.
+                pass
+        run = path.with_name(f"run-{path.name[len('new-'):]}")
+        os.rename(path, run)
+        return run
+
+    def _remove_stale(self, runs):
+        """Remove the archives directories of processes that exited."""
+        for path in runs.glob("run-*"):
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Still in use.
+                continue
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        """Remove the archives directory of this process."""
+        if self._lock is None:
+            return
+        shutil.rmtree(self.cachedir, ignore_errors=True)
+        os.close(self._lock)
+        self._lock = None
+
+    def bind_args(self):
+        """bwrap arguments mounting the cache into a sandbox."""
+        if not self.enabled():
+            return []
+        return ["--bind", str(self.cachedir), "/var/cache/apt/archives"]
+
+    def archive_name(self, version):
+        """File name apt stores the archive of a package version under."""
+        name = apt_pkg.quote_string(version.package.shortname, "_:")
+        ver = apt_pkg.quote_string(version.version, "_:")
+        arch = apt_pkg.quote_string(version.architecture, "_:.")
+        return f"{name}_{ver}_{arch}.deb"
+
+    def object_path(self, sha256):
+        """Location of an archive in the content-addressed store."""
+        return self.objects.joinpath(f"{sha256}.deb")
+
+    def prefetch(self, changes, workers=4):
+        """Download the archives for a change set ahead of dpkg.
+
+        Archives are downloaded concurrently into the cache and verified
+        against the index hashes. The hits and misses are accounted here,
+        and not again by the record() of the apt run that follows.
+        Returns True when every archive needed by the change set is
+        present, so apt can run without downloading.
+        """
+        if not self.enabled():
+            return False
+
+        versions = [pkg.candidate for pkg in changes
+                    if pkg.marked_install or pkg.marked_upgrade or
+                    pkg.marked_downgrade]
+        hits = []
+        missing = []
+        for version in versions:
+            if self.link(version):
+                hits.append(version)
+            else:
+                missing.append(version)
+
+        fetched = []
+        if len(missing) > 0:
+            total = sum(v.size for v in missing)
+            self.logging.info(
+                f"Downloading {len(missing)} packages ({total} bytes) with "
+                f"{workers} workers.")
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(self._download, missing))
+            # Link every archive that was downloaded, even if some failed.
+            fetched = [v for v in missing if self.link(v)]
+
+        self.prefetched = {self.archive_name(v) for v in hits + fetched}
+        self.logging.info(
+            f"Package cache: {len(hits)} hits, {len(fetched)} misses.")
+        self._update_stats(len(hits), len(fetched),
+                           sum(v.size for v in hits))
+        return len(fetched) == len(missing)
+
+    def link(self, version):
+        """Make the stored archive of a version visible to apt.
+
+        Returns False when the archive is not in the cache. Versions
+        without a sha256 in the index are only known by their name.
+        """
+        dest = self.cachedir.joinpath(self.archive_name(version))
+        if not version.sha256:
+            return self._verify(dest, version)
+        obj = self.object_path(version.sha256)
+        try:
+            if os.path.getsize(obj) != version.size:
+                os.unlink(obj)
+                return False
+            # Mark as recently used for eviction.
+            os.utime(obj)
+            self._link_name(obj, self.names.joinpath(dest.name))
+            self._link_name(obj, dest)
+        except FileNotFoundError:
+            # Not stored, or evicted by a concurrent run.
+            return False
+        return True
+
+    def _link_name(self, obj, dest):
+        """Atomically hardlink a stored archive under an apt name."""
+        if os.path.exists(dest) and os.path.samefile(obj, dest):
+            return
+        tmp = self.cachedir.joinpath(
+            f"partial/{dest.name}.{os.getpid()}.{threading.get_ident()}")
+        os.link(obj, tmp)
+        os.rename(tmp, dest)
+
+    def _download(self, version):
+        """Fetch the archive of a package version from its mirrors."""
+        if version.sha256:
+            dest = self.object_path(version.sha256)
+        else:
+            dest = self.cachedir.joinpath(self.archive_name(version))
+        for uri in version.uris:
+            tmp = tempfile.NamedTemporaryFile(
+                dir=self.cachedir.joinpath("partial"), delete=False)
+            try:
+                with tmp, urllib.request.urlopen(uri, timeout=60) as r:
+                    shutil.copyfileobj(r, tmp, 1 << 20)
+                if self._verify(tmp.name, version):
+                    os.rename(tmp.name, dest)
+                    if not version.sha256:
+                        self._store(dest)
+                    return True
+                self.logging.warning(f"Hash mismatch for {uri}.")
+            except OSError as e:
+                self.logging.debug(f"Failed to download {uri}: {e}")
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+        self.logging.warning(f"Failed to download {version.package.name}.")
+        return False
+
+    def _store(self, path):
+        """Add an archive apt downloaded to the content-addressed store."""
+        m = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    m.update(chunk)
+            obj = self.object_path(m.hexdigest())
+            try:
+                os.link(path, obj)
+            except FileExistsError:
+                pass
+            self._link_name(obj, self.names.joinpath(path.name))
+        except FileNotFoundError:
+            # Evicted by a concurrent run.
+            pass
+
+    def _verify(self, path, version):
+        """Check an archive against the size and hash in the index."""
+        try:
+            if os.path.getsize(path) != version.size:
+                return False
+        except OSError:
+            return False
+        if not version.sha256:
+            return True
+        m = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                m.update(chunk)
+        return m.hexdigest() == version.sha256
+
+    def snapshot(self):
+        """Names of the archives currently in the cache."""
+        if not self.enabled():
+            return set()
+        return {p.name for p in self.cachedir.glob("*.deb")}
+
+    def record(self, before, changes=None):
+        """Account for an apt run and trim the cache.
+
+        before is the snapshot taken ahead of the run and changes the
+        packages apt was asked to install or upgrade, when known.
+        """
+        if not self.enabled():
+            return
+
+        downloaded = self.snapshot() - before
+        for name in downloaded:
+            self._store(self.cachedir.joinpath(name))
+        hits = set()
+        if changes:
+            wanted = {self.archive_name(pkg.candidate) for pkg in changes
+                      if pkg.marked_install or pkg.marked_upgrade or
+                      pkg.marked_downgrade}
+            hits = (wanted & before) - self.prefetched
+        self.prefetched = set()
+        hit_bytes = 0
+        for name in hits:
+            path = self.cachedir.joinpath(name)
+            try:
+                # Mark as recently used for eviction.
+                os.utime(path)
+                hit_bytes += path.stat().st_size
+            except FileNotFoundError:
+                # Evicted by a concurrent run.
+                continue
+
+        self.logging.info(
+            f"Package cache: {len(hits)} hits, {len(downloaded)} misses.")
+        self._update_stats(len(hits), len(downloaded), hit_bytes)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used archives until under the size cap.
+
+        The names apt knows the evicted archives by are removed as well.
+        Names not in the store yet, such as archives apt just downloaded,
+        are left alone. Other runs keep their links to the archives they
+        use until they finish.
+        """
+        archives = []
+        for path in self.objects.glob("*.deb"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            archives.append((st.st_mtime, st.st_size, st.st_ino, path))
+
+        archives.sort()
+        total = sum(size for _, size, _, _ in archives)
+        evicted = set()
+        while archives and total > self.max_size:
+            _, size, ino, path = archives.pop(0)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # Evicted by a concurrent run.
+                pass
+            evicted.add(ino)
+            total -= size
+        if not evicted:
+            return
+
+        for path in list(self.names.glob("*.deb")) + \
+                list(self.cachedir.glob("*.deb")):
+            try:
+                if path.stat().st_ino in evicted:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _update_stats(self, hits, misses, hit_bytes):
+        """Add to the running totals kept next to the cache."""
+        with open(self.stats_file, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                stats = json.load(f)
+            except ValueError:
+                stats = {"hits": 0, "misses": 0, "hit_bytes": 0}
+            stats["hits"] += hits
+            stats["misses"] += misses
+            stats["hit_bytes"] += hit_bytes
+            f.seek(0)
+            f.truncate()
+            json.dump(stats, f)
@@ -0,0 +1,257 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+import re
+import shutil
+
+from apt_ostree.utils import move_tree
+
+# Prefixes of the boot artifacts that belong to a kernel version.
+PREFIXES = [
+    ("vmlinuz-", "kernel"),
+    ("initrd.img-", "initramfs"),
+    ("initramfs-", "initramfs"),
+    ("dtbs-", "dtbs"),
+]
+
+# Boot checksum suffix of the artifacts in /usr/lib/ostree-boot.
+CHECKSUM = re.compile(r"-[0-9a-f]{64}$")
+
+
+class Boot:
+    """Kernels and their boot artifacts in a tree."""
+
+    def __init__(self, state):
+        self.logging = logging.getLogger(__name__)
+        self.state = state
+
+    def find_boot_sets(self, bootdir):
+        """Group the kernels in bootdir with their initramfs and dtbs.
+
+        Returns a dict mapping each kernel version to the names of its
+        artifacts by kind, and the list of the other files in bootdir.
+        """
+        sets = {}
+        others = []
+        for item in sorted(os.listdir(bootdir)):
+            for prefix, kind in PREFIXES:
+                if item.startswith(prefix):
+                    version = item[len(prefix):]
+                    if kind == "initramfs" and version.endswith(".img"):
+                        version = version[:-len(".img")]
+                    sets.setdefault(version, {})[kind] = item
+                    break
+            else:
+                others.append(item)
+
+        for version in list(sets):
+            if "kernel" not in sets[version]:
+                # No kernel to boot it with, keep it as is.
+                others += sets.pop(version).values()
+        return sets, others
+
+    def boot_checksum(self, paths):
+        """sha256 of the content of boot artifacts, read in chunks.
+
+        Directories such as dtbs are hashed file by file in sorted order.
+        """
+        m = hashlib.sha256()
+        for path in paths:
+            if not os.path.isdir(path):
+                _hash_file(m, path)
+                continue
+            for base, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    p = os.path.join(base, name)
+                    m.update(os.path.relpath(p, path).encode("utf-8") + b"\0")
+                    _hash_file(m, p)
+        return m.hexdigest()
+
+    def setup_boot(self, bootdir, targetdir):
+        """Move the boot artifacts in bootdir to the ostree boot directory.
+
+        Every kernel is renamed to vmlinuz-<version>-<checksum> and its
+        initramfs to initramfs-<version>-<checksum>, where the checksum
+        covers the kernel, initramfs and dtbs of that version. The sets
+        are hashed in parallel. Only the set of the default kernel is
+        kept in targetdir, see select_default. Returns the checksum of
+        every version.
+        """
+        os.makedirs(targetdir, exist_ok=True)
+        modulesdir = _modules_dir(targetdir)
+        sets, others = self.find_boot_sets(bootdir)
+
+        for item in others:
+            # Move all other artifacts as is
+            _replace(os.path.join(bootdir, item),
+                     os.path.join(targetdir, item))
+
+        def checksum(version):
+            return self.boot_checksum(
+                [os.path.join(bootdir, sets[version][kind])
+                 for kind in ["kernel", "initramfs", "dtbs"]
+                 if kind in sets[version]])
+
+        versions = sorted(sets)
+        with ThreadPoolExecutor(max_workers=max(len(versions), 1)) as pool:
+            csums = dict(zip(versions, pool.map(checksum, versions)))
+
+        for version, csum in csums.items():
+            artifacts = sets[version]
+            setdir = os.path.join(modulesdir, version)
+            os.makedirs(setdir, exist_ok=True)
+            _remove_stale(targetdir, version)
+            _remove_stale(setdir, version)
+            os.rename(os.path.join(bootdir, artifacts["kernel"]),
+                      os.path.join(setdir, f"vmlinuz-{version}-{csum}"))
+            if "initramfs" in artifacts:
+                os.rename(
+                    os.path.join(bootdir, artifacts["initramfs"]),
+                    os.path.join(setdir, f"initramfs-{version}-{csum}"))
+            if "dtbs" in artifacts:
+                move_tree(os.path.join(bootdir, artifacts["dtbs"]),
+                          os.path.join(setdir, artifacts["dtbs"]))
+            self.logging.debug(f"Boot checksum of {version}: {csum}")
+        self.select_default(targetdir)
+        return csums
+
+    def select_default(self, targetdir):
+        """Keep the boot artifacts of the default kernel in targetdir.
+
+        libostree deploys the first vmlinuz and initramfs it reads from
+        the ostree boot directory, so it must hold a single set. The
+        other sets are kept in usr/lib/modules/<version>, under names
+        libostree does not look for. The default kernel is the one
+        configured with --default-kernel, or else the highest version.
+        Returns the default version, or None without any kernel.
+        """
+        modulesdir = _modules_dir(targetdir)
+        current = _kernel_versions(targetdir)
+        versions = set(current)
+        if os.path.isdir(modulesdir):
+            for version in os.listdir(modulesdir):
+                setdir = os.path.join(modulesdir, version)
+                if version in _kernel_versions(setdir):
+                    versions.add(version)
+        if len(versions) == 0:
+            return None
+
+        default = self.state.default_kernel
+        if default not in versions:
+            if default:
+                self.logging.warning(
+                    f"Default kernel {default} not found, using the "
+                    "highest version.")
+            default = max(versions, key=_version_key)
+
+        for version in current - {default}:
+            _move_set(targetdir, os.path.join(modulesdir, version), version)
+        if default not in current:
+            _move_set(os.path.join(modulesdir, default), targetdir, default)
+        self.logging.info(f"Default kernel: {default}")
+        return default
+
+    def update_boot(self, rootfs):
+        """Refresh the ostree boot directory after a package transaction.
+
+        Kernels installed by the transaction are moved out of /boot, and
+        kernels whose modules were removed are dropped.
+        """
+        bootdir = rootfs.joinpath("boot")
+        targetdir = rootfs.joinpath("usr/lib/ostree-boot")
+        csums = {}
+        if bootdir.exists() and any(
+                item.startswith("vmlinuz-") for item in os.listdir(bootdir)):
+            csums = self.setup_boot(bootdir, targetdir)
+
+        if not targetdir.exists():
+            return csums
+        modules = rootfs.joinpath("usr/lib/modules")
+        for version in _kernel_versions(targetdir):
+            if not modules.joinpath(version).exists():
+                self.logging.info(f"Removing kernel {version}.")
+                _remove_stale(targetdir, version)
+        if modules.exists():
+            for version in os.listdir(modules):
+                setdir = modules.joinpath(version)
+                items = os.listdir(setdir)
+                if items and all(_in_set(item, version) for item in items):
+                    # Only the boot artifacts are left of this kernel.
+                    self.logging.info(f"Removing kernel {version}.")
+                    shutil.rmtree(setdir)
+        self.select_default(targetdir)
+        return csums
+
+
+def _hash_file(m, path):
+    """Feed a file to a hash 1 MiB at a time."""
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            m.update(chunk)
+
+
+def _modules_dir(targetdir):
+    """Kernel module directory next to the ostree boot directory."""
+    return os.path.join(os.path.dirname(os.path.normpath(targetdir)),
+                        "modules")
+
+
+def _in_set(item, version):
+    """Check whether item is a boot artifact of the set of version."""
+    if item == f"dtbs-{version}":
+        return True
+    return CHECKSUM.search(item) is not None and \
+        CHECKSUM.sub("", item) in [f"vmlinuz-{version}",
+                                   f"initramfs-{version}"]
+
+
+def _kernel_versions(path):
+    """Versions of the renamed kernels in a directory."""
+    versions = set()
+    for item in os.listdir(path):
+        if item.startswith("vmlinuz-") and CHECKSUM.search(item):
+            versions.add(CHECKSUM.sub("", item)[len("vmlinuz-"):])
+    return versions
+
+
+def _version_key(version):
+    """Sort key comparing the numbers in kernel versions numerically."""
+    return [(0, int(part)) if part.isdigit() else (1, part)
+            for part in re.findall(r"\d+|\D+", version)]
+
+
+def _move_set(src, dst, version):
+    """Move the boot artifacts of a version from src to dst."""
+    os.makedirs(dst, exist_ok=True)
+    for item in os.listdir(src):
+        if _in_set(item, version):
+            _replace(os.path.join(src, item), os.path.join(dst, item))
+
+
+def _remove_stale(targetdir, version):
+    """Remove the renamed kernel, initramfs and dtbs of a version."""
+    for item in os.listdir(targetdir):
+        if _in_set(item, version):
+            path = os.path.join(targetdir, item)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+
+
+def _replace(src, dst):
+    """Move src to dst, replacing what is there."""
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.unlink(dst)
+    move_tree(src, dst)
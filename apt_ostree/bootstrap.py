@@ -5,17 +5,27 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 
-import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import shutil
 import sys
 
-import apt
 from rich.console import Console
-
+import yaml
+
+from apt_ostree.apt import Apt
+from apt_ostree.archives import ArchiveCache
+from apt_ostree.boot import Boot
+from apt_ostree.bootstrap_cache import BootstrapCache
+from apt_ostree.bootstrap_cache import CONFIG_KEY
+from apt_ostree.bootstrap_cache import HOOKS_KEY
 from apt_ostree.constants import excluded_packages
+from apt_ostree.deploy import Deploy
+from apt_ostree import dpkg
 from apt_ostree.ostree import Ostree
+from apt_ostree.utils import move_tree
 from apt_ostree.utils import run_command
 
 
@@ -25,9 +35,16 @@ class Bootstrap:
         self.console = Console()
         self.state = state
         self.ostree = Ostree(self.state)
+        self.cache = BootstrapCache(self.state)
+
+    def create_rootfs(self, use_cache=True, incremental=True):
+        """Create a Debian system from a configuration file.
 
-    def create_rootfs(self):
-        """Create a Debian system from a configuration file."""
+        When the inputs of the bootstrap are unchanged since a previous
+        run, the branch is pointed at the commit of that run instead.
+        When only the package list changed since the last commit of the
+        branch, the packages are installed or removed on top of it.
+        """
         if not self.state.base.exists():
             self.logging.error("Configuration directory does not exist.")
             sys.exit(1)
@@ -40,6 +57,28 @@ class Bootstrap:
         else:
             self.logging.info("Found configuration file bootstrap.yaml.")
 
+        key = None
+        if use_cache:
+            key = self.cache.key(config)
+            if self.reuse(key):
+                return
+        if incremental:
+            rev = self.update_rootfs(config)
+            if rev is not None:
+                if key is not None:
+                    self.cache.store(key, rev)
+                return
+
+        rev = self.build(config)
+        if key is not None:
+            self.cache.store(key, rev)
+        self.ostree.update_static_deltas(self.state.branch)
+
+    def build(self, config):
+        """Bootstrap the branch from scratch and commit it.
+
+        Returns the new commit.
+        """
         with self.console.status(
                 f"Setting up workspace for {self.state.branch}."):
             workspace = self.state.workspace
@@ -59,25 +98,189 @@ class Bootstrap:
         verbosity = "-q"
         if self.state.debug:
             verbosity = "-v"
+        archives = ArchiveCache(self.state)
+        before = archives.snapshot()
         run_command(
-            ["bdebstrap", "-c", "bootstrap.yaml", verbosity,
+            ["bdebstrap", "-c", str(config.resolve()), verbosity,
              "--force", "--name", str(self.state.branch),
              "--target", str(rootfs),
-             "--output", str(workdir)], cwd=self.state.base)
+             "--output", str(workdir)] + self.archive_hooks(archives),
+            cwd=self.state.base)
+        # Add what mmdebstrap downloaded to the store and trim it.
+        archives.record(before)
+        archives.close()
 
         self.ostree.init()
         self.logging.info(f"Found ostree branch: {self.state.branch}")
         self.create_ostree(rootfs)
-        r = self.ostree.ostree_commit(
+        stats = self.ostree.ostree_commit(
             rootfs,
             branch=self.state.branch,
             repo=self.state.repo,
             subject="Commit by apt-ostree",
-            msg="Initialized by apt-ostree.")
-        if r.returncode != 0:
-            self.logging.info(f"Failed to commit {self.state.branch} to "
-                              f"{self.state.repo}.")
+            msg="Initialized by apt-ostree.",
+            metadata=dict(self.config_metadata(config),
+                          **self.ostree.package_metadata(rootfs)),
+            consume=True)
         self.logging.info(f"Commited {self.state.repo} to {self.state.repo}.")
+        return stats["commit"]
+
+    def reuse(self, key):
+        """Point the branch at the commit of an identical bootstrap.
+
+        Only done when the branch does not exist yet or already points
+        at that commit, a branch is never moved back to an older commit.
+        Returns False if the commit cannot be reused.
+        """
+        if key is None:
+            return False
+        rev = self.cache.lookup(key)
+        if rev is None:
+            return False
+        self.ostree.init()
+        if not self.ostree.has_commit(rev):
+            return False
+
+        _, current = self.ostree.open_ostree().resolve_rev(
+            self.state.branch, True)
+        if current == rev:
+            self.logging.info(
+                f"{self.state.branch} is up to date ({rev[:10]}).")
+            return True
+        if current is not None:
+            self.logging.info(
+                f"{self.state.branch} has commits after the bootstrap "
+                f"({rev[:10]}), not reusing it.")
+            return False
+        if self.state.branch not in self.ostree.ref_bindings(rev):
+            # Built for another branch, clients would refuse it.
+            return False
+
+        self.logging.info(
+            f"Inputs unchanged, pointing {self.state.branch} at "
+            f"{rev[:10]}.")
+        self.ostree.set_ref(self.state.branch, rev)
+        self.ostree.update_static_deltas(self.state.branch)
+        return True
+
+    def archive_hooks(self, archives):
+        """bdebstrap arguments sharing the package cache with mmdebstrap.
+
+        The cache is bind-mounted over the archives directory of the
+        chroot, so packages are neither copied in nor out, and unmounted
+        before mmdebstrap cleans up. Where mounting is not possible the
+        packages are downloaded into the chroot as usual. Either way no
+        archive is left in the tree.
+        """
+        archives_dir = '"$1"/var/cache/apt/archives'
+        cleanup = ["--customize-hook",
+                   f"mountpoint -q {archives_dir} || "
+                   f"rm -rf {archives_dir}/*.deb {archives_dir}/partial/*"]
+        if not archives.enabled():
+            return cleanup
+        cache = archives.cachedir
+        return [
+            "--skip", "download/empty",
+            "--skip", "essential/unlink",
+            "--setup-hook",
+            f"mkdir -p {archives_dir} && "
+            f"mount --bind {cache} {archives_dir} || true",
+            "--customize-hook",
+            f"! mountpoint -q {archives_dir} || umount {archives_dir}",
+        ] + cleanup
+
+    def config_metadata(self, config):
+        """Commit metadata recording the configuration of a build."""
+        text = config.read_text()
+        mmdebstrap = (yaml.safe_load(text) or {}).get("mmdebstrap", {})
+        return self.ostree.string_metadata({
+            CONFIG_KEY: text,
+            HOOKS_KEY: self.cache.hooks_digest(mmdebstrap),
+        })
+
+    def update_rootfs(self, config):
+        """Apply package list changes to the last commit of the branch.
+
+        Only possible when the configuration the commit was built from
+        is recorded and differs from the current one in the package list
+        alone. Returns the new commit, or None if a full bootstrap is
+        needed.
+        """
+        self.ostree.init()
+        _, parent = self.ostree.open_ostree().resolve_rev(
+            self.state.branch, True)
+        if parent is None:
+            return None
+        old = self.ostree.read_metadata(parent, CONFIG_KEY)
+        if old is None:
+            return None
+
+        old = (yaml.safe_load(old) or {})
+        new = (yaml.safe_load(config.read_text()) or {})
+        old_packages = set(old.get("mmdebstrap", {}).pop("packages", []))
+        new_packages = set(new.get("mmdebstrap", {}).pop("packages", []))
+        if old != new:
+            self.logging.info("Configuration changed, bootstrapping.")
+            return None
+        if self.ostree.read_metadata(parent, HOOKS_KEY) != \
+           self.cache.hooks_digest(new.get("mmdebstrap", {})):
+            self.logging.info("Hook files changed, bootstrapping.")
+            return None
+        if old_packages == new_packages:
+            return None
+
+        installed = self.ostree.installed_packages(parent)
+        install = sorted(p for p in new_packages - old_packages
+                         if p not in installed)
+        remove = sorted(p for p in old_packages - new_packages
+                        if p in installed)
+        self.logging.info(
+            f"Updating {self.state.branch} ({parent[:10]}): installing "
+            f"{len(install)} and removing {len(remove)} packages.")
+
+        deploy = Deploy(self.state)
+        rootfs = deploy.get_sysroot(self.state.branch)
+        deploy.prestaging(rootfs)
+        self.apply_packages(rootfs, install, remove)
+        deploy.poststaging(rootfs)
+
+        msg = "Package list changed.\n\n"
+        msg += "".join(f"- {p} (installed)\n" for p in install)
+        msg += "".join(f"- {p} (removed)\n" for p in remove)
+        rev = deploy.commit(
+            rootfs,
+            branch=self.state.branch,
+            subject="Commit by apt-ostree",
+            msg=msg,
+            metadata=self.config_metadata(config))
+        deploy.cleanup(rootfs, rev=rev)
+        return rev
+
+    def apply_packages(self, rootfs, install, remove):
+        """Install and remove packages in a staged tree.
+
+        The symlinks from /usr to /var the packages ship are replaced as
+        in a full bootstrap, so both give the same tree.
+        """
+        apt = Apt(self.state)
+        apt.apt_update(rootfs)
+        cache = apt.cache(rootfs)
+        missing = [p for p in install if p not in cache]
+        if missing:
+            self.logging.error(f"Unknown packages: {', '.join(missing)}")
+            sys.exit(1)
+        offline = False
+        if install:
+            for package in install:
+                apt.apt_package(cache, package).mark_install()
+            offline = apt.archives.prefetch(
+                cache.get_changes(), workers=self.state.fetch_workers)
+            cache.clear()
+        if install or remove:
+            apt.apt_transaction(cache, install, remove, rootfs,
+                                offline=offline)
+            self.sanitize_usr_symlinks(rootfs)
+            self.create_tmpfile_dir(rootfs, packages=install + remove)
 
     def create_ostree(self, rootdir):
         """Create an ostree branch from a rootfs."""
@@ -104,19 +307,15 @@ class Bootstrap:
         shutil.rmtree(rootdir.joinpath("dev"))
         os.mkdir(rootdir.joinpath("dev"), dir_perm)
 
-        # Copying /var
+        # Moving /var
         self.sanitize_usr_symlinks(rootdir)
         self.logging.info("Moving /var to /usr/rootdirs.")
         os.mkdir(rootdir.joinpath("usr/rootdirs"), dir_perm)
         # Make sure we preserve file permissions otherwise
         # bubblewrap will complain that a file/directory
         # permisisons/onership is not mapped correctly.
-        shutil.copytree(
-          rootdir.joinpath("var"),
-          rootdir.joinpath("usr/rootdirs/var"),
-          symlinks=True
-        )
-        shutil.rmtree(rootdir.joinpath("var"))
+        move_tree(rootdir.joinpath("var"),
+                  rootdir.joinpath("usr/rootdirs/var"))
         os.mkdir(rootdir.joinpath("var"), dir_perm)
 
         # Remove unecessary files
@@ -129,8 +328,8 @@ class Bootstrap:
 
         # Setup and split out etc
         self.logging.info("Moving /etc to /usr/etc.")
-        shutil.move(rootdir.joinpath("etc"),
-                    rootdir.joinpath("usr"))
+        move_tree(rootdir.joinpath("etc"),
+                  rootdir.joinpath("usr/etc"))
 
         self.logging.info("Setting up /ostree and /sysroot.")
         try:
@@ -157,113 +356,138 @@ class Bootstrap:
             os.symlink(t, l, dir_fd=fd)
 
     def sanitize_usr_symlinks(self, rootdir):
-        """Replace symlinks from /usr pointing to /var"""
+        """Replace symlinks from /usr pointing to /var
+
+        The subdirectories of /usr are scanned in parallel. Returns the
+        (link, target) paths relative to rootdir that were replaced by
+        hardlinks.
+        """
+        rootdir = os.fspath(rootdir)
         usrdir = os.path.join(rootdir, "usr")
-        for base, dirs, files in os.walk(usrdir):
-            for name in files:
-                p = os.path.join(base, name)
-
-                if not os.path.islink(p):
-                    continue
-
-                # Resolve symlink relative to root
-                link = os.readlink(p)
-                if os.path.isabs(link):
-                    target = os.path.join(rootdir, link[1:])
-                else:
-                    target = os.path.join(base, link)
-
-                rel = os.path.relpath(target, rootdir)
-                # Keep symlinks if they're pointing to a location under /usr
-                if os.path.commonpath([target, usrdir]) == usrdir:
-                    continue
-
-                toplevel = self.get_toplevel(rel)
-                # Sanitize links going into /var, potentially
-                # other location can be added later
-                if toplevel != 'var':
-                    continue
-
-                os.remove(p)
-                os.link(target, p)
-
-    def get_toplevel(self, path):
-        """Get the top level diretory."""
-        head, tail = os.path.split(path)
-        while head != '/' and head != '':
-            head, tail = os.path.split(head)
-
-        return tail
+        rewritten, subdirs = _sanitize_dir(rootdir, usrdir)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            for result in pool.map(
+                    lambda d: _sanitize_tree(rootdir, d), subdirs):
+                rewritten += result
+
+        for link, target in rewritten:
+            self.logging.debug(f"Replaced symlink /{link} -> /{target}")
+        self.logging.info(
+            f"Replaced {len(rewritten)} symlinks from /usr to /var.")
+        return rewritten
 
     def setup_boot(self, rootdir, bootdir, targetdir):
         """Setup up the ostree bootdir"""
-        vmlinuz = None
-        initrd = None
-        dtbs = None
-        version = None
-
-        try:
-            os.mkdir(targetdir)
-        except OSError:
-            pass
-
-        for item in os.listdir(bootdir):
-            if item.startswith("vmlinuz"):
-                assert vmlinuz is None
-                vmlinuz = item
-                _, version = item.split("-", 1)
-            elif item.startswith("initrd.img") or item.startswith("initramfs"):
-                assert initrd is None
-                initrd = item
-            elif item.startswith("dtbs"):
-                assert dtbs is None
-                dtbs = os.path.join(bootdir, item)
-            else:
-                # Move all other artifacts as is
-                shutil.move(os.path.join(bootdir, item), targetdir)
-        assert vmlinuz is not None
-
-        m = hashlib.sha256()
-        m.update(open(os.path.join(bootdir, vmlinuz), mode="rb").read())
-        if initrd is not None:
-            m.update(open(os.path.join(bootdir, initrd), "rb").read())
-
-        csum = m.hexdigest()
-
-        os.rename(os.path.join(bootdir, vmlinuz),
-                  os.path.join(targetdir, vmlinuz + "-" + csum))
+        csums = Boot(self.state).setup_boot(bootdir, targetdir)
+        if len(csums) == 0:
+            self.logging.error(f"No kernel found in {bootdir}.")
+            sys.exit(1)
+        for version, csum in csums.items():
+            self.logging.info(f"Found kernel {version} ({csum[:10]}).")
 
-        if initrd is not None:
-            os.rename(os.path.join(bootdir, initrd),
-                      os.path.join(targetdir,
-                                   initrd.replace(
-                                       "initrd.img", "initramfs")
-                                   + "-" + csum))
+    def create_tmpfile_dir(self, rootdir, packages=None):
+        """Ensure directoeies in /var are created.
 
-    def create_tmpfile_dir(self, rootdir):
-        """Ensure directoeies in /var are created."""
+        The paths are read from the dpkg file lists. With packages, only
+        the lists of those packages are read and merged into the existing
+        configuration, dropping entries that are no longer in the tree.
+        """
         self.logging.info("Creating systemd-tmpfiles configuration")
-        cache = apt.cache.Cache(rootdir=rootdir)
-        dirs = []
-        for pkg in cache:
-           if "/var" in pkg.installed_files and \
-              pkg.name not in excluded_packages:
-              dirs += [file for file in pkg.installed_files
-                       if file.startswith("/var")]
-           if len(dirs) == 0:
-                return
-           conf = rootdir.joinpath(
-               "usr/lib/tmpfiles.d/ostree-integration-autovar.conf")
-           if conf.exists():
-               os.unlink(conf)
-           with open(conf, "w") as f:
-               f.write("# Auto-genernated by apt-ostree\n")
-               for d in (dirs):
-                   if d not in [
-                        "/var",
-                        "/var/lock",
-                        "/var/cache",
-                        "/var/spool",
-                        "/var/log",
-                        "/var/lib"]:
-                     f.write(f"L {d} - - - - ../../usr/rootdirs{d}\n")
+        conf = rootdir.joinpath(
+            "usr/lib/tmpfiles.d/ostree-integration-autovar.conf")
+
+        paths = collections.defaultdict(set)
+        for pkg, path in dpkg.file_lists(rootdir, packages):
+            if pkg not in excluded_packages and \
+               (path == "/var" or path.startswith("/var/")):
+                paths[pkg].add(path)
+        dirs = set()
+        for files in paths.values():
+            if "/var" in files:
+                dirs |= files
+
+        if packages is not None and conf.exists():
+            dirs |= self._read_tmpfile_conf(conf)
+            dirs = {d for d in dirs
+                    if os.path.lexists(rootdir.joinpath(f"usr/rootdirs{d}"))}
+        if len(dirs) == 0 and not conf.exists():
+            return
+
+        # Never write in place, the tree may be hardlinked to the repo.
+        if conf.exists():
+            os.unlink(conf)
+        conf.parent.mkdir(parents=True, exist_ok=True)
+        with open(conf, "w") as f:
+            f.write("# Auto-genernated by apt-ostree\n")
+            for d in sorted(dirs):
+                if d not in [
+                     "/var",
+                     "/var/lock",
+                     "/var/cache",
+                     "/var/spool",
+                     "/var/log",
+                     "/var/lib"]:
+                    f.write(f"L {d} - - - - ../../usr/rootdirs{d}\n")
+
+    def _read_tmpfile_conf(self, conf):
+        """Paths in an existing autovar configuration."""
+        dirs = set()
+        with open(conf, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] == "L":
+                    dirs.add(fields[1])
+        return dirs
+
+
+def _sanitize_tree(rootdir, path):
+    """Sanitize the symlinks of a directory tree."""
+    rewritten = []
+    stack = [path]
+    while stack:
+        result, subdirs = _sanitize_dir(rootdir, stack.pop())
+        rewritten += result
+        stack += subdirs
+    return rewritten
+
+
+def _sanitize_dir(rootdir, path):
+    """Replace the symlinks to /var in a single directory.
+
+    Only symlinks into /var are stat()ed, everything else is classified
+    from the directory entry type. Returns the rewritten links and the
+    subdirectories to scan next.
+    """
+    rewritten = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if not entry.is_symlink():
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                continue
+
+            # Resolve symlink relative to root
+            link = os.readlink(entry.path)
+            if os.path.isabs(link):
+                rel = os.path.normpath(link.lstrip("/"))
+            else:
+                rel = os.path.normpath(os.path.join(
+                    os.path.relpath(path, rootdir), link))
+
+            # Sanitize links going into /var, potentially other
+            # locations can be added later. Links pointing to a location
+            # under /usr are kept.
+            if rel.split(os.sep, 1)[0] != "var":
+                continue
+
+            # Links to directories are kept.
+            target = os.path.join(rootdir, rel)
+            if os.path.isdir(target):
+                continue
+
+            os.remove(entry.path)
+            os.link(target, entry.path)
+            rewritten.append(
+                (os.path.relpath(entry.path, rootdir), rel))
+    return rewritten, subdirs
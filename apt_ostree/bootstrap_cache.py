@@ -0,0 +1,208 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shlex
+import urllib.request
+
+import yaml
+
+from apt_ostree.constants import VERSION
+from apt_ostree.utils import get_cache_dir
+
+# Hooks that can copy files from the configuration directory.
+HOOKS = ["setup-hooks", "extract-hooks", "essential-hooks",
+         "customize-hooks", "cleanup-hooks"]
+
+# mmdebstrap's mirror when bootstrap.yaml does not name one.
+DEFAULT_MIRROR = "http://deb.debian.org/debian"
+
+# Commit metadata recording what a bootstrap was built from.
+CONFIG_KEY = "apt-ostree.bootstrap.config"
+HOOKS_KEY = "apt-ostree.bootstrap.hooks"
+
+
+class BootstrapCache:
+    """Commits of previous bootstraps, keyed by their inputs.
+
+    The key covers bootstrap.yaml, the files and directories of the
+    configuration directory that the hooks reference, such as overlays
+    for sync-in, and the Release files of the apt sources, which change
+    whenever the archive does. The index of keys to commits is kept in
+    <workspace>/cache/bootstrap/index.json.
+    """
+
+    def __init__(self, state):
+        self.logging = logging.getLogger(__name__)
+        self.state = state
+        self.index = get_cache_dir(self.state, "bootstrap").joinpath(
+            "index.json")
+
+    def key(self, config):
+        """Compute the key of a bootstrap configuration.
+
+        Returns None when a Release file cannot be fetched, as the
+        result of the bootstrap cannot be predicted then.
+        """
+        with open(config, "r") as f:
+            mmdebstrap = (yaml.safe_load(f) or {}).get("mmdebstrap", {})
+
+        m = hashlib.sha256()
+        m.update(f"apt-ostree {VERSION}\0".encode("utf-8"))
+        # The default kernel decides which boot set the tree boots.
+        m.update(f"{self.state.default_kernel}\0".encode("utf-8"))
+        m.update(config.read_bytes())
+        paths = self._hook_paths(mmdebstrap)
+        for path in paths:
+            self._hash_tree(m, path)
+
+        for url in self._release_urls(mmdebstrap, paths):
+            release = self._fetch_release(url)
+            if release is None:
+                return None
+            m.update(url.encode("utf-8") + b"\0" + release)
+        return m.hexdigest()
+
+    def hooks_digest(self, mmdebstrap):
+        """Hash the files in the configuration directory the hooks use."""
+        return self.files_digest(self._hook_paths(mmdebstrap))
+
+    def files_digest(self, paths):
+        """Hash files and directory trees of the configuration directory."""
+        m = hashlib.sha256()
+        for path in paths:
+            self._hash_tree(m, path)
+        return m.hexdigest()
+
+    def sources_digest(self, sources):
+        """Hash the Release files of apt sources.list lines.
+
+        Returns None when a Release file cannot be fetched.
+        """
+        m = hashlib.sha256()
+        for url in self._release_urls({"mirrors": sources}, []):
+            release = self._fetch_release(url)
+            if release is None:
+                return None
+            m.update(url.encode("utf-8") + b"\0" + release)
+        return m.hexdigest()
+
+    def lookup(self, key):
+        """Return the commit stored for key, or None."""
+        return self._load().get(key)
+
+    def store(self, key, rev):
+        """Record the commit built for key."""
+        with open(self.index, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                index = json.load(f)
+            except ValueError:
+                index = {}
+            index[key] = rev
+            f.seek(0)
+            f.truncate()
+            json.dump(index, f)
+
+    def _load(self):
+        try:
+            with open(self.index, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _hook_paths(self, mmdebstrap):
+        """Paths in the configuration directory named by the hooks."""
+        paths = set()
+        for name in HOOKS:
+            for hook in mmdebstrap.get(name, []):
+                try:
+                    words = shlex.split(hook)
+                except ValueError:
+                    words = hook.split()
+                for word in words:
+                    if os.path.isabs(word):
+                        continue
+                    path = self.state.base.joinpath(word)
+                    if path.exists():
+                        paths.add(path)
+        return sorted(paths)
+
+    def _hash_tree(self, m, top):
+        """Hash the names, modes and content of a file or tree."""
+        if not top.is_dir():
+            paths = [top]
+        else:
+            paths = []
+            for base, dirs, files in os.walk(top):
+                dirs.sort()
+                paths += [os.path.join(base, name)
+                          for name in sorted(dirs + files)]
+
+        for path in paths:
+            st = os.lstat(path)
+            rel = os.path.relpath(path, self.state.base)
+            m.update(f"{rel}:{st.st_mode}\0".encode("utf-8"))
+            if os.path.islink(path):
+                m.update(os.readlink(path).encode("utf-8"))
+            elif os.path.isfile(path):
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        m.update(chunk)
+
+    def _release_urls(self, mmdebstrap, paths):
+        """URLs of the Release files of the apt sources."""
+        suite = mmdebstrap.get("suite", "")
+        sources = list(mmdebstrap.get("mirrors", []))
+        # Sources lists copied in by the hooks.
+        for path in paths:
+            etc = path.joinpath("etc/apt")
+            for sources_list in [etc.joinpath("sources.list")] + \
+                    sorted(etc.glob("sources.list.d/*.list")):
+                if sources_list.is_file():
+                    sources += sources_list.read_text().splitlines()
+        if len(sources) == 0:
+            sources = [DEFAULT_MIRROR]
+
+        urls = []
+        for line in sources:
+            words = line.split("#", 1)[0].split()
+            if len(words) == 0 or words[0] == "deb-src":
+                continue
+            if words[0] == "deb":
+                words = words[1:]
+                # Skip the [option=value ...] list.
+                while words and words[0].startswith("["):
+                    opt = words.pop(0)
+                    while not opt.endswith("]") and words:
+                        opt = words.pop(0)
+            if len(words) == 0:
+                continue
+            uri = words[0].rstrip("/")
+            dist = words[1] if len(words) > 1 else suite
+            if dist.endswith("/"):
+                # Flat repository.
+                urls.append(f"{uri}/{dist}")
+            else:
+                urls.append(f"{uri}/dists/{dist}/")
+        return sorted(set(urls))
+
+    def _fetch_release(self, url):
+        """Download the InRelease or Release file of a source."""
+        for name in ["InRelease", "Release"]:
+            try:
+                with urllib.request.urlopen(url + name, timeout=30) as r:
+                    return r.read()
+            except OSError as e:
+                self.logging.debug(f"Failed to fetch {url}{name}: {e}")
+        self.logging.warning(f"Unable to fetch the Release file at {url}.")
+        return None
@@ -11,9 +11,25 @@ class State:
     def __init__(self):
         self.debug = False
         self.workspace = None
+        # Shared cache directory, <workspace>/cache when unset.
+        self.cache_dir = None
         self.repo = None
         self.branch = None
         self.feed = None
+        self.staging = "copy"
+        self.staging_cache_size = 0
+        self.archive_cache_size = 4 << 30
+        self.apt_lists_max_age = 3600
+        self.fetch_workers = 4
+        self.progress_format = "rich"
+        self.static_deltas = 0
+        self.static_delta_from_empty = False
+        self.fetch_depth = 0
+        self.fetch_deltas = "auto"
+        self.network_retries = 5
+        self.commit_metadata_only = False
+        self.localcache_repos = ()
+        self.default_kernel = None
 
 
 # pass state between command and apt-ostree sub-commands
@@ -11,6 +11,8 @@ from apt_ostree.cmd.compose.backup import backup
 from apt_ostree.cmd.compose.checkout import checkout
 from apt_ostree.cmd.compose.commit import commit
 from apt_ostree.cmd.compose.create import create
+from apt_ostree.cmd.compose.delta import delta
+from apt_ostree.cmd.compose.diff import diff
 from apt_ostree.cmd.compose.image import image
 from apt_ostree.cmd.compose.init import init
 from apt_ostree.cmd.compose.install import install
@@ -31,6 +33,8 @@ compose.add_command(backup)
 compose.add_command(checkout)
 compose.add_command(commit)
 compose.add_command(create)
+compose.add_command(delta)
+compose.add_command(diff)
 compose.add_command(image)
 compose.add_command(init)
 compose.add_command(install)
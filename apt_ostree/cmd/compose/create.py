@@ -11,16 +11,102 @@ import sys
 import click
 
 from apt_ostree.bootstrap import Bootstrap
-from apt_ostree.cmd.options import compose_options
+from apt_ostree.cmd.options import base_option
+from apt_ostree.cmd.options import repo_option
 from apt_ostree.cmd import pass_state_context
+from apt_ostree.matrix import BuildMatrix
+from apt_ostree.treefile import Treefile
+from apt_ostree.utils import parse_size
+
+
+def _parse_memory(ctxt, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_size(value)
+    except ValueError:
+        raise click.BadParameter(f"Invalid size: {value}")
 
 
 @click.command(short_help="Create treefile.")
 @pass_state_context
-@compose_options
-def create(state, repo, base, branch):
+@repo_option
+@base_option
+@click.option(
+    "--no-cache",
+    help="Bootstrap even if the inputs are unchanged",
+    is_flag=True,
+    default=False
+)
+@click.option(
+    "--full",
+    help="Bootstrap from scratch instead of updating the last commit "
+         "when only the package list changed",
+    is_flag=True,
+    default=False
+)
+@click.option(
+    "--all", "build_all",
+    help="Build a branch for every bootstrap.yaml below --base",
+    is_flag=True,
+    default=False
+)
+@click.option(
+    "--jobs",
+    help="Number of branches to build in parallel",
+    type=click.IntRange(min=1),
+    default=None
+)
+@click.option(
+    "--worker-cpus",
+    help="Number of CPUs each parallel build may use",
+    type=click.IntRange(min=1),
+    default=None
+)
+@click.option(
+    "--worker-memory",
+    help="Address space limit of each parallel build (e.g. 8G)",
+    default=None,
+    callback=_parse_memory
+)
+@click.option(
+    "--treefile",
+    help="Compose the branch in stages from this treefile in --base",
+    default=None
+)
+@click.argument("branches", nargs=-1)
+def create(state, repo, base, no_cache, full, build_all, jobs, worker_cpus,
+           worker_memory, treefile, branches):
+    """Bootstrap a branch from the configuration in --base.
+
+    With several branches or --all, --base is a directory of
+    configurations and each branch is built from the subdirectory of
+    the same name, in parallel.
+
+    With --treefile, the stages of the treefile whose inputs changed
+    since the last run are applied on top of the result of the previous
+    stages.
+    """
+    if not build_all and len(branches) == 0:
+        raise click.UsageError("Missing argument 'BRANCH'.")
+    if treefile and (build_all or len(branches) > 1):
+        raise click.UsageError("--treefile composes a single branch.")
     try:
-        Bootstrap(state).create_rootfs()
+        if treefile:
+            state.branch = branches[0]
+            Treefile(state).compose(state.base.joinpath(treefile),
+                                    use_cache=not no_cache)
+        elif build_all or len(branches) > 1:
+            BuildMatrix(state).build(branches,
+                                     jobs=jobs,
+                                     cpus=worker_cpus,
+                                     memory=worker_memory,
+                                     use_cache=not no_cache,
+                                     incremental=not full)
+        else:
+            state.branch = branches[0]
+            Bootstrap(state).create_rootfs(use_cache=not no_cache,
+                                           incremental=not full)
     except KeyboardInterrupt:
         click.secho("\n" + ("Exiting at your request."))
         sys.exit(130)
@@ -0,0 +1,47 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import errno
+import sys
+
+import click
+
+from apt_ostree.cmd.options import branch_option
+from apt_ostree.cmd.options import repo_option
+from apt_ostree.cmd import pass_state_context
+from apt_ostree.ostree import Ostree
+
+
+@click.command(
+    help="Generate static deltas to the head of a branch.")
+@pass_state_context
+@branch_option
+@repo_option
+@click.option(
+    "--depth",
+    help="Number of previous commits to generate deltas from",
+    type=click.IntRange(min=0),
+    default=1
+)
+@click.option(
+    "--from-empty",
+    help="Also generate a delta from an empty tree",
+    is_flag=True,
+    default=False
+)
+def delta(state, branch, repo, depth, from_empty):
+    try:
+        Ostree(state).generate_static_deltas(
+            branch, depth, from_empty=from_empty)
+    except KeyboardInterrupt:
+        click.secho("\n" + ("Exiting at your request."))
+        sys.exit(130)
+    except BrokenPipeError:
+        sys.exit()
+    except OSError as error:
+        if error.errno == errno.ENOSPC:
+            sys.exit("error - No space left on device.")
@@ -0,0 +1,40 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import errno
+import sys
+
+import click
+
+from apt_ostree.cmd.options import repo_option
+from apt_ostree.cmd import pass_state_context
+from apt_ostree.compose import Compose
+
+
+@click.command(
+    help="Compare the packages in two commits or branches.")
+@pass_state_context
+@repo_option
+@click.option(
+    "--json", "as_json",
+    help="Output the comparison as JSON",
+    is_flag=True,
+    default=False
+)
+@click.argument("rev_a", nargs=1)
+@click.argument("rev_b", nargs=1)
+def diff(state, repo, as_json, rev_a, rev_b):
+    try:
+        Compose(state).diff(rev_a, rev_b, as_json)
+    except KeyboardInterrupt:
+        click.secho("\n" + ("Exiting at your request."))
+        sys.exit(130)
+    except BrokenPipeError:
+        sys.exit()
+    except OSError as error:
+        if error.errno == errno.ENOSPC:
+            sys.exit("error - No space left on device.")
@@ -11,6 +11,7 @@ import sys
 import click
 
 from apt_ostree.cmd.options import branch_option
+from apt_ostree.cmd.options import download_only_option
 from apt_ostree.cmd.options import repo_option
 from apt_ostree.cmd import pass_state_context
 from apt_ostree.packages import Packages
@@ -21,11 +22,13 @@ from apt_ostree.packages import Packages
 @pass_state_context
 @branch_option
 @repo_option
+@download_only_option
 def upgrade(state,
             branch,
-            repo):
+            repo,
+            download_only):
     try:
-        Packages(state).upgrade()
+        Packages(state).upgrade(download_only)
     except KeyboardInterrupt:
         click.secho("\n" + ("Exiting at your request."))
         sys.exit(130)
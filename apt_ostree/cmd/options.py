@@ -10,6 +10,7 @@ import pathlib
 import click
 
 from apt_ostree.cmd import State
+from apt_ostree.utils import parse_size
 
 """global options"""
 
@@ -42,6 +43,136 @@ def workspace_option(f):
     )(f)
 
 
+def staging_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.staging = value
+        return value
+    return click.option(
+        "--staging",
+        help="Checkout mode for staging trees",
+        type=click.Choice(["copy", "reflink", "overlay"]),
+        default="copy",
+        callback=callback
+    )(f)
+
+
+def staging_cache_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        try:
+            state.staging_cache_size = parse_size(value)
+        except ValueError:
+            raise click.BadParameter(f"Invalid size: {value}")
+        return value
+    return click.option(
+        "--staging-cache-size",
+        help="Keep committed staging trees up to this size (e.g. 20G)",
+        default="0",
+        callback=callback
+    )(f)
+
+
+def archive_cache_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        try:
+            state.archive_cache_size = parse_size(value)
+        except ValueError:
+            raise click.BadParameter(f"Invalid size: {value}")
+        return value
+    return click.option(
+        "--archive-cache-size",
+        help="Size of the shared package download cache (0 to disable)",
+        default="4G",
+        callback=callback
+    )(f)
+
+
+def apt_lists_max_age_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.apt_lists_max_age = value
+        return value
+    return click.option(
+        "--apt-lists-max-age",
+        help="Seconds before cached package lists are refreshed",
+        type=int,
+        default=3600,
+        callback=callback
+    )(f)
+
+
+def fetch_workers_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.fetch_workers = value
+        return value
+    return click.option(
+        "--fetch-workers",
+        help="Number of parallel package downloads",
+        type=click.IntRange(min=1),
+        default=4,
+        callback=callback
+    )(f)
+
+
+def progress_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.progress_format = value
+        return value
+    return click.option(
+        "--progress",
+        help="How to report the progress of pulls",
+        type=click.Choice(["rich", "json", "none"]),
+        default="rich",
+        callback=callback
+    )(f)
+
+
+def static_deltas_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.static_deltas = value
+        return value
+    return click.option(
+        "--static-deltas",
+        help="Generate static deltas from this many previous commits "
+             "after each commit",
+        type=click.IntRange(min=0),
+        default=0,
+        callback=callback
+    )(f)
+
+
+def static_delta_from_empty_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.static_delta_from_empty = value
+        return value
+    return click.option(
+        "--static-delta-from-empty",
+        help="Also generate a static delta from an empty tree",
+        is_flag=True,
+        default=False,
+        callback=callback
+    )(f)
+
+
+def default_kernel_option(f):
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.default_kernel = value
+        return value
+    return click.option(
+        "--default-kernel",
+        help="Kernel version to boot when a tree has several kernels",
+        default=None,
+        callback=callback
+    )(f)
+
+
 """compose options"""
 
 
@@ -225,6 +356,22 @@ def packages_option(f):
     )(f)
 
 
+def download_only_option(f):
+    """Only download packages."""
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.download_only = value
+        return value
+    return click.option(
+        "--download-only",
+        help="Download packages into the package cache without "
+             "committing",
+        is_flag=True,
+        default=False,
+        callback=callback
+    )(f)
+
+
 """remotes"""
 
 
@@ -255,6 +402,103 @@ def url_option(f):
     )(f)
 
 
+"""fetch"""
+
+
+def fetch_depth_option(f):
+    """Commit history depth to pull."""
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.fetch_depth = value
+        return value
+    return click.option(
+        "--depth",
+        help="Number of parent commits to pull (-1 for all)",
+        type=click.IntRange(min=-1),
+        default=0,
+        envvar="APT_OSTREE_FETCH_DEPTH",
+        show_envvar=True,
+        callback=callback
+    )(f)
+
+
+def fetch_deltas_option(f):
+    """Static delta preference."""
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.fetch_deltas = value
+        return value
+    return click.option(
+        "--deltas",
+        help="Use static deltas when available, never, or fail "
+             "without them",
+        type=click.Choice(["auto", "disable", "require"]),
+        default="auto",
+        envvar="APT_OSTREE_FETCH_DELTAS",
+        show_envvar=True,
+        callback=callback
+    )(f)
+
+
+def network_retries_option(f):
+    """Retries for network errors."""
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.network_retries = value
+        return value
+    return click.option(
+        "--network-retries",
+        help="Number of times to retry on network errors",
+        type=click.IntRange(min=0),
+        default=5,
+        envvar="APT_OSTREE_FETCH_NETWORK_RETRIES",
+        show_envvar=True,
+        callback=callback
+    )(f)
+
+
+def commit_metadata_only_option(f):
+    """Only pull commit objects."""
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.commit_metadata_only = value
+        return value
+    return click.option(
+        "--commit-metadata-only",
+        help="Only pull the commit objects, not the content",
+        is_flag=True,
+        default=False,
+        envvar="APT_OSTREE_FETCH_COMMIT_METADATA_ONLY",
+        show_envvar=True,
+        callback=callback
+    )(f)
+
+
+def localcache_repo_option(f):
+    """Local repositories to take objects from."""
+    def callback(ctxt, param, value):
+        state = ctxt.ensure_object(State)
+        state.localcache_repos = value
+        return value
+    return click.option(
+        "--localcache-repo",
+        help="Local repository to copy objects from before downloading",
+        multiple=True,
+        envvar="APT_OSTREE_FETCH_LOCALCACHE_REPOS",
+        show_envvar=True,
+        callback=callback
+    )(f)
+
+
+def fetch_options(f):
+    f = fetch_depth_option(f)
+    f = fetch_deltas_option(f)
+    f = network_retries_option(f)
+    f = commit_metadata_only_option(f)
+    f = localcache_repo_option(f)
+    return f
+
+
 """deploy"""
 
 
@@ -11,6 +11,7 @@ import sys
 import click
 
 from apt_ostree.cmd.options import branch_argument
+from apt_ostree.cmd.options import fetch_options
 from apt_ostree.cmd.options import reboot_option
 from apt_ostree.cmd import pass_state_context
 from apt_ostree.rebase import Rebase
@@ -26,8 +27,10 @@ from apt_ostree.rebase import Rebase
     is_flag=True,
     default=False
 )
+@fetch_options
 @branch_argument
-def rebase(state, reboot, update, branch):
+def rebase(state, reboot, update, depth, deltas, network_retries,
+           commit_metadata_only, localcache_repo, branch):
     try:
         Rebase(state).rebase(update)
     except KeyboardInterrupt:
@@ -13,7 +13,16 @@ from apt_ostree.cmd.apt import apt
 from apt_ostree.cmd.compose import compose
 from apt_ostree.cmd.deploy import deploy
 from apt_ostree.cmd.install import install
+from apt_ostree.cmd.options import apt_lists_max_age_option
+from apt_ostree.cmd.options import archive_cache_option
 from apt_ostree.cmd.options import debug_option
+from apt_ostree.cmd.options import default_kernel_option
+from apt_ostree.cmd.options import fetch_workers_option
+from apt_ostree.cmd.options import progress_option
+from apt_ostree.cmd.options import staging_cache_option
+from apt_ostree.cmd.options import staging_option
+from apt_ostree.cmd.options import static_delta_from_empty_option
+from apt_ostree.cmd.options import static_deltas_option
 from apt_ostree.cmd.options import workspace_option
 from apt_ostree.cmd import pass_state_context
 from apt_ostree.cmd.rebase import rebase
@@ -32,7 +41,18 @@ from apt_ostree.log import setup_log
 @pass_state_context
 @debug_option
 @workspace_option
-def cli(state, debug, workspace):
+@staging_option
+@staging_cache_option
+@archive_cache_option
+@apt_lists_max_age_option
+@fetch_workers_option
+@progress_option
+@static_deltas_option
+@static_delta_from_empty_option
+@default_kernel_option
+def cli(state, debug, workspace, staging, staging_cache_size,
+        archive_cache_size, apt_lists_max_age, fetch_workers, progress,
+        static_deltas, static_delta_from_empty, default_kernel):
     setup_log()
 
     if state.debug:
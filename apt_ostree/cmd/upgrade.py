@@ -10,6 +10,7 @@ import sys
 
 import click
 
+from apt_ostree.cmd.options import download_only_option
 from apt_ostree.cmd import pass_state_context
 from apt_ostree.packages import Packages
 
@@ -17,9 +18,10 @@ from apt_ostree.packages import Packages
 @click.command(
     help="Upgrade Debian packages.")
 @pass_state_context
-def upgrade(state):
+@download_only_option
+def upgrade(state, download_only):
     try:
-        Packages(state).upgrade()
+        Packages(state).upgrade(download_only)
     except KeyboardInterrupt:
         click.secho("\n" + ("Exiting at your request."))
         sys.exit(130)
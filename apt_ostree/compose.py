@@ -4,15 +4,19 @@ Copyright (c) 2023 Wind River Systems, Inc.
 SPDX-License-Identifier: Apache-2.0
 
 """
+import json
 import logging
 import pathlib
 import shutil
 import sys
 
 
+import click
 from rich.console import Console
+from rich.table import Table
 
 from apt_ostree.deploy import Deploy
+from apt_ostree import dpkg
 from apt_ostree.ostree import Ostree
 from apt_ostree.repo import Repo
 
@@ -95,26 +99,71 @@ class Compose:
             self.logging.error("Failed to fetch commit")
             sys.exit(1)
         with self.console.status(f"Commiting {rev[:10]}."):
-            r = self.ostree.ostree_commit(
+            self.ostree.ostree_commit(
                 root=self.rootfs,
                 branch=self.state.branch,
                 parent=rev,
                 repo=self.state.repo,
                 subject="Forked from parent",
-                msg=f"Forked from {parent} ({rev[:10]})."
+                msg=f"Forked from {parent} ({rev[:10]}).",
+                metadata=self.ostree.package_metadata(self.rootfs),
+                consume=True
             )
-            if r.returncode != 0:
-                self.logging.error("Failed to commit.")
-                sys.exit(1)
 
         self.logging.info(f"Successfully commited {self.state.branch}"
                           f"({rev[:10]}) from {parent}.")
         self.logging.info("Cleaning up.")
         try:
-            shutil.rmtree(self.rootfs)
+            if self.rootfs.exists():
+                shutil.rmtree(self.rootfs)
         except OSError as e:
             self.logging.error(f"Failed to remove rootfs {self.rootfs}: {e}")
 
+    def diff(self, rev_a, rev_b, as_json=False):
+        """Compare the packages installed in two commits."""
+        csum_a = self.ostree.resolve_rev(rev_a)
+        csum_b = self.ostree.resolve_rev(rev_b)
+        diff = dpkg.diff_manifests(self._get_manifest(csum_a),
+                                   self._get_manifest(csum_b))
+
+        if as_json:
+            diff["from"] = csum_a
+            diff["to"] = csum_b
+            click.echo(json.dumps(diff, indent=2))
+            return
+
+        table = Table(box=None)
+        table.add_column("Package")
+        table.add_column("Change")
+        table.add_column(f"{rev_a} ({csum_a[:10]})")
+        table.add_column(f"{rev_b} ({csum_b[:10]})")
+        table.add_column("Size (KiB)", justify="right")
+        for change in ["added", "removed", "upgraded", "downgraded"]:
+            for pkg in diff[change]:
+                table.add_row(
+                    pkg["name"],
+                    change,
+                    pkg.get("old_version",
+                            pkg["version"] if change == "removed" else ""),
+                    pkg.get("new_version",
+                            pkg["version"] if change == "added" else ""),
+                    f"{pkg['size_delta']:+d}")
+        self.console.print(table)
+        self.console.print(
+            f"\n{len(diff['added'])} added, {len(diff['removed'])} removed, "
+            f"{len(diff['upgraded'])} upgraded, "
+            f"{len(diff['downgraded'])} downgraded, "
+            f"{diff['size_delta']:+d} KiB installed size.",
+            highlight=False)
+
+    def _get_manifest(self, rev):
+        """Package manifest of a commit, without checking it out."""
+        manifest = self.ostree.read_manifest(rev)
+        if manifest is None:
+            status = self.ostree.read_commit_file(rev, dpkg.STATUS)
+            manifest = dpkg.manifest_from_status(dpkg.parse_status(status))
+        return manifest
+
     def _checkout(self, rootfs=None, branch=None):
         """Checkout a commit from an ostree branch."""
         if branch is not None:
@@ -13,7 +13,10 @@ import sys
 
 from rich.console import Console
 
+from apt_ostree.boot import Boot
 from apt_ostree.ostree import Ostree
+from apt_ostree.staging import OverlayCache
+from apt_ostree.staging import StagingCache
 from apt_ostree import utils
 
 
@@ -23,11 +26,16 @@ class Deploy:
         self.logging = logging.getLogger(__name__)
         self.state = state
         self.ostree = Ostree(self.state)
+        self.boot = Boot(self.state)
+        self.staging = StagingCache(self.state)
+        self.overlay = OverlayCache(self.state)
 
         self.workspace = self.state.workspace
         self.workdir = self.state.workspace.joinpath("deployment")
         self.workdir.mkdir(parents=True, exist_ok=True)
         self.rootfs = None
+        self.rev = None
+        self.upperdir = None
 
     def prestaging(self, rootfs):
         """Pre stage steps."""
@@ -72,6 +80,8 @@ class Deploy:
             sys.exit(1)
 
         self.logging.info("Running post deploy steps.")
+        # Move kernels installed by the transaction into place.
+        self.boot.update_boot(rootfs)
         fd = os.open(rootfs, os.O_DIRECTORY)
         if os.path.exists(rootfs.joinpath("etc")):
             os.unlink("etc", dir_fd=fd)
@@ -84,10 +94,72 @@ class Deploy:
                 os.unlink("var", dir_fd=fd)
                 os.mkdir("var", dir_fd=fd, mode=0o755)
 
-    def cleanup(self, rootfs):
-        """Remove workspace directores to save space."""
+    def commit(self, rootfs, branch, subject, msg, metadata=None):
+        """Commit a staged rootfs and return the new commit checksum.
+
+        metadata is added to the package manifest stored with the commit.
+        """
+        metadata = dict(metadata or {},
+                        **self.ostree.package_metadata(rootfs))
+        if self.upperdir is not None:
+            stats = self.ostree.ostree_commit_overlay(
+                self.upperdir,
+                self.rev,
+                branch,
+                subject=subject,
+                msg=msg,
+                metadata=metadata,
+            )
+        else:
+            # The tree is removed after the commit unless the staging
+            # cache keeps it, so let ostree consume it.
+            stats = self.ostree.ostree_commit(
+                root=str(rootfs),
+                branch=branch,
+                parent=self.rev,
+                repo=self.state.repo,
+                subject=subject,
+                msg=msg,
+                metadata=metadata,
+                consume=not self.staging.enabled(),
+            )
+        self.logging.info(
+            f"Wrote {stats['content_objects_written']} new files "
+            f"({stats['content_bytes_written']} bytes).")
+        self.ostree.update_static_deltas(branch)
+        return stats["commit"]
+
+    def cleanup(self, rootfs, rev=None):
+        """Remove workspace directores to save space.
+
+        If rev is the commit that was just made from rootfs, the tree is
+        kept in the staging cache so the next transaction on that commit
+        does not need to check it out again.
+        """
+        if self.upperdir is not None:
+            self._cleanup_overlay(rootfs, rev)
+            return
+        if rev and self.staging.enabled():
+            self.staging.store(rev, rootfs)
+            return
         with self.console.status("Cleaning up."):
-            shutil.rmtree(rootfs)
+            # Committing with consume already removed most of the tree.
+            if rootfs.exists():
+                shutil.rmtree(rootfs)
+
+    def _cleanup_overlay(self, rootfs, rev):
+        """Unmount an overlay staging tree and keep its changes."""
+        utils.run_command(["umount", str(rootfs)])
+        os.rmdir(rootfs)
+        shutil.rmtree(self.upperdir.with_suffix(".work"))
+        if rev:
+            self.overlay.add_layer(rev, self.rev, self.upperdir)
+        else:
+            shutil.rmtree(self.upperdir)
+        self.upperdir = None
+
+        _, refs = self.ostree.open_ostree().list_refs(None, None)
+        self.overlay.prune(refs.values())
 
     def get_sysroot(self, branch=None):
         """Checkout the commit to the specified directory."""
@@ -98,11 +170,67 @@ class Deploy:
             self.workdir = self.workdir.joinpath(branch)
             self.workdir.mkdir(parents=True, exist_ok=True)
             self.rootfs = self.workdir.joinpath(rev)
+            self.rev = rev
+            if os.path.ismount(self.rootfs):
+                utils.run_command(["umount", str(self.rootfs)])
             if self.rootfs.exists():
                 shutil.rmtree(self.rootfs)
-            self.ostree.ostree_checkout(branch, self.rootfs)
+            if self.state.staging == "overlay":
+                self._mount_overlay(branch, rev)
+                return self.rootfs
+            if self.staging.take(rev, self.rootfs):
+                return self.rootfs
+            if self.state.staging == "reflink":
+                # apt and maintainer scripts write anywhere in the tree,
+                # so it is never hardlinked to the cache repository.
+                repo = self.ostree.open_checkout_repo(branch)
+                self.ostree.ostree_checkout(branch, self.rootfs, repo=repo,
+                                            copy=True)
+            else:
+                self.ostree.ostree_checkout(branch, self.rootfs)
         return self.rootfs
 
+    def _mount_overlay(self, branch, rev):
+        """Stage a commit as an overlayfs mount.
+
+        The lower layers are shared read-only between transactions, so
+        they are checked out with hardlinks. Changes made by apt land in
+        a per-transaction upper directory.
+        """
+        lowers = self.overlay.lowerdirs(rev)
+        if lowers is None:
+            layer = self.overlay.layer_path(rev)
+            if layer.parent.exists():
+                shutil.rmtree(layer.parent)
+            layer.parent.mkdir(parents=True)
+            repo = self.ostree.open_checkout_repo(branch)
+            self.ostree.ostree_checkout(branch, layer, repo=repo)
+            lowers = [layer]
+
+        self.upperdir = self.workdir.joinpath(f"{rev}.upper")
+        work = self.upperdir.with_suffix(".work")
+        for d in [self.upperdir, work]:
+            if d.exists():
+                shutil.rmtree(d)
+            d.mkdir(mode=0o755)
+        self.rootfs.mkdir()
+
+        lowerdir = ":".join(str(lower) for lower in lowers)
+        r = utils.run_command(
+            ["mount", "-t", "overlay", "overlay",
+             "-o", f"lowerdir={lowerdir},upperdir={self.upperdir},"
+                   f"workdir={work},"
+                   # The upper directory is committed as is, so it must
+                   # hold full copies and no redirects, whatever the
+                   # kernel defaults are.
+                   "metacopy=off,redirect_dir=off,index=off",
+             str(self.rootfs)],
+            check=False
+        )
+        if r.returncode != 0:
+            self.logging.error(f"Failed to mount overlay for {rev[:10]}.")
+            sys.exit(1)
+
     def deploy(self, reboot):
         """Run ostree admin deploy."""
         ref = self.ostree.ostree_ref(self.state.branch)
@@ -0,0 +1,206 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import collections
+import os
+import pathlib
+
+import apt_pkg
+
+# Location of the dpkg database in a committed tree.
+STATUS = "usr/rootdirs/var/lib/dpkg/status"
+# Per package file lists in the dpkg database.
+INFO = "var/lib/dpkg/info"
+# apt's record of automatically installed packages.
+EXTENDED_STATES = "var/lib/apt/extended_states"
+
+# Commit metadata holding the package manifest, see manifest().
+MANIFEST_KEY = "apt-ostree.packages"
+MANIFEST_VERSION_KEY = "apt-ostree.packages.version"
+MANIFEST_VERSION = 1
+
+
+def _lines(chunks):
+    """Split an iterable of byte chunks into decoded lines."""
+    buf = b""
+    for chunk in chunks:
+        buf += chunk
+        lines = buf.split(b"\n")
+        buf = lines.pop()
+        for line in lines:
+            yield line.decode("utf-8", errors="replace")
+    if buf:
+        yield buf.decode("utf-8", errors="replace")
+
+
+def parse_status(chunks):
+    """Parse a dpkg status file given as an iterable of byte chunks.
+
+    Yields one dict of fields per package without holding the whole
+    file in memory.
+    """
+    stanza = {}
+    key = None
+    for line in _lines(chunks):
+        if not line.strip():
+            if stanza:
+                yield stanza
+            stanza = {}
+            key = None
+        elif line[0] in " \t":
+            if key is not None:
+                stanza[key] += "\n" + line[1:]
+        else:
+            key, _, value = line.partition(":")
+            stanza[key] = value.strip()
+    if stanza:
+        yield stanza
+
+
+def read_status(path):
+    """Parse the dpkg status file at path."""
+    with open(path, "rb") as f:
+        yield from parse_status(iter(lambda: f.read(1 << 16), b""))
+
+
+def is_installed(stanza):
+    """Check the Status field of a stanza for an installed package."""
+    return stanza.get("Status", "").endswith(" installed")
+
+
+def installed_packages(stanzas):
+    """Names of the installed packages in parsed status stanzas."""
+    return {s["Package"] for s in stanzas if is_installed(s)}
+
+
+def file_lists(rootfs, packages=None):
+    """Stream the files installed by packages from the dpkg database.
+
+    Yields (package, path) for every entry of the .list files, reading
+    one file at a time. With packages, only the lists of those package
+    names are read.
+    """
+    info = _find(rootfs, INFO)
+    if packages is not None:
+        packages = {pkg.split(":")[0] for pkg in packages}
+    with os.scandir(info) as it:
+        for entry in it:
+            if not entry.name.endswith(".list"):
+                continue
+            # Multi-arch packages are listed as name:arch.list.
+            name = entry.name[:-len(".list")].split(":")[0]
+            if packages is not None and name not in packages:
+                continue
+            with open(entry.path, "rb") as f:
+                for line in f:
+                    yield name, line.rstrip(b"\n").decode(
+                        "utf-8", errors="replace")
+
+
+def _find(rootfs, path):
+    """Locate a /var path in a tree before or after conversion."""
+    rootfs = pathlib.Path(rootfs)
+    converted = rootfs.joinpath("usr/rootdirs", path)
+    if converted.exists():
+        return converted
+    return rootfs.joinpath(path)
+
+
+def auto_installed(rootfs):
+    """(name, architecture) of packages apt marked as auto installed."""
+    path = _find(rootfs, EXTENDED_STATES)
+    if not path.exists():
+        return set()
+    return {(s["Package"], s.get("Architecture", ""))
+            for s in read_status(path)
+            if s.get("Auto-Installed") == "1"}
+
+
+def manifest(rootfs):
+    """Build the package manifest of a tree.
+
+    Returns a list of (name, version, architecture, manual, installed
+    size in KiB) tuples sorted by name, stored in commit metadata under
+    MANIFEST_KEY.
+    """
+    path = _find(rootfs, "var/lib/dpkg/status")
+    if not path.exists():
+        return []
+    return manifest_from_status(read_status(path), auto_installed(rootfs))
+
+
+def manifest_from_status(stanzas, auto=None):
+    """Build manifest entries from parsed status stanzas."""
+    auto = auto or set()
+    packages = []
+    for s in stanzas:
+        if not is_installed(s):
+            continue
+        arch = s.get("Architecture", "")
+        packages.append((
+            s["Package"],
+            s.get("Version", ""),
+            arch,
+            (s["Package"], arch) not in auto,
+            int(s.get("Installed-Size", "0") or 0),
+        ))
+    return sorted(packages)
+
+
+def diff_manifests(old, new):
+    """Compare two package manifests.
+
+    Returns a dict with the added, removed, upgraded and downgraded
+    packages and the total change in installed size in KiB.
+    """
+    apt_pkg.init_system()
+    old = _by_name(old)
+    new = _by_name(new)
+    diff = {
+        "added": [],
+        "removed": [],
+        "upgraded": [],
+        "downgraded": [],
+    }
+    for name in sorted(new.keys() - old.keys()):
+        version, size = new[name]
+        diff["added"].append(
+            {"name": name, "version": version, "size_delta": size})
+    for name in sorted(old.keys() - new.keys()):
+        version, size = old[name]
+        diff["removed"].append(
+            {"name": name, "version": version, "size_delta": -size})
+    for name in sorted(old.keys() & new.keys()):
+        (old_version, old_size), (new_version, new_size) = \
+            old[name], new[name]
+        cmp = apt_pkg.version_compare(new_version, old_version)
+        if cmp == 0:
+            continue
+        diff["upgraded" if cmp > 0 else "downgraded"].append({
+            "name": name,
+            "old_version": old_version,
+            "new_version": new_version,
+            "size_delta": new_size - old_size,
+        })
+    diff["size_delta"] = sum(
+        p["size_delta"] for changes in diff.values() for p in changes)
+    return diff
+
+
+def _by_name(manifest):
+    """Index manifest entries by package name.
+
+    Packages installed for more than one architecture are qualified
+    with the architecture.
+    """
+    counts = collections.Counter(pkg[0] for pkg in manifest)
+    packages = {}
+    for name, version, arch, _, size in manifest:
+        if counts[name] > 1:
+            name = f"{name}:{arch}"
+        packages[name] = (version, size)
+    return packages
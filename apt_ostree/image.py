@@ -5,13 +5,19 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 
+import json
 import logging
+import os
 import shutil
+import subprocess
 
 from rich.console import Console
 
 from apt_ostree.utils import run_command
 
+# Files of the image template copied by the last build.
+TEMPLATE_MANIFEST = ".apt-ostree-template.json"
+
 
 class Image:
     def __init__(self, state):
@@ -20,7 +26,12 @@ class Image:
         self.state = state
 
     def create_image(self):
-        """Create a raw disk image from an ostree repository."""
+        """Create a raw disk image from an ostree repository.
+
+        The image build directory is kept between builds: only the
+        template files that changed are copied again, and the branch is
+        pulled incrementally into the image build repository.
+        """
         self.logging.info(f"Found ostree repository: {self.state.repo}")
         self.logging.info(f"Found ostree branch: {self.state.branch}")
         with self.console.status(
@@ -29,22 +40,24 @@ class Image:
                 f"build/{self.state.branch}")
             img_dir = workdir.joinpath("image")
             ostree_repo = img_dir.joinpath("ostree_repo")
-            if img_dir.exists():
-                shutil.rmtree(img_dir)
-            shutil.copytree(
-                self.state.base.joinpath("image"),
-                img_dir, dirs_exist_ok=True)
+            img_dir.mkdir(parents=True, exist_ok=True)
+            copied = self.sync_template(
+                self.state.base.joinpath("image"), img_dir)
+            self.logging.info(f"Updated {copied} image template files.")
 
-        self.logging.info("Creating image build repository")
-        run_command(
-            ["ostree", "init", f"--repo={str(ostree_repo)}"],
-            cwd=img_dir)
+        self.setup_repo(ostree_repo)
         self.logging.info(
             f"Pulling {self.state.branch} in image build repository")
         run_command(
             ["ostree", "pull-local", f"--repo={str(ostree_repo)}",
              str(self.state.repo), str(self.state.branch)],
             cwd=img_dir)
+        # Only the commit being deployed is needed.
+        run_command(
+            ["ostree", "prune", f"--repo={str(ostree_repo)}",
+             "--refs-only", "--depth=0"],
+            stdout=subprocess.DEVNULL,
+            cwd=img_dir)
         self.logging.info("Running debos...")
 
         cmd = [
@@ -58,3 +71,92 @@ class Image:
         run_command(cmd, cwd=img_dir)
 
         self.logging.info(f"Image can be found in {img_dir}")
+
+    def setup_repo(self, ostree_repo):
+        """Create the image build repository unless it can be reused.
+
+        It uses the mode of the source repository, so that pull-local
+        hardlinks the objects instead of copying them when both are on
+        the same filesystem.
+        """
+        mode = self._repo_mode(self.state.repo)
+        if ostree_repo.exists():
+            if self._repo_mode(ostree_repo) == mode:
+                return
+            self.logging.info(
+                "Image build repository mode changed, recreating it.")
+            shutil.rmtree(ostree_repo)
+
+        self.logging.info("Creating image build repository")
+        run_command(
+            ["ostree", "init", f"--repo={str(ostree_repo)}",
+             f"--mode={mode}"])
+
+    def _repo_mode(self, repo):
+        r = run_command(
+            ["ostree", "config", f"--repo={str(repo)}", "get", "core.mode"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=False)
+        if r is None or r.returncode != 0:
+            return None
+        return r.stdout.decode("utf-8").strip()
+
+    def sync_template(self, src, dst):
+        """Copy the files of src that changed since the last build to dst.
+
+        Files are compared by size and modification time, which copy2
+        preserves. Files removed from src since the last build are
+        removed from dst, other files in dst such as built images are
+        kept. Returns the number of files copied.
+        """
+        manifest = dst.joinpath(TEMPLATE_MANIFEST)
+        try:
+            with open(manifest, "r") as f:
+                previous = set(json.load(f))
+        except (OSError, ValueError):
+            previous = set()
+
+        copied = 0
+        current = set()
+        for base, dirs, files in os.walk(src):
+            rel = os.path.relpath(base, src)
+            for name in dirs:
+                path = os.path.join(base, name)
+                if os.path.islink(path):
+                    files.append(name)
+                else:
+                    os.makedirs(os.path.join(dst, rel, name), exist_ok=True)
+            for name in files:
+                path = os.path.join(base, name)
+                target = os.path.normpath(os.path.join(dst, rel, name))
+                current.add(os.path.relpath(target, dst))
+                if _unchanged(path, target):
+                    continue
+                if os.path.lexists(target):
+                    os.unlink(target)
+                shutil.copy2(path, target, follow_symlinks=False)
+                copied += 1
+
+        for rel in sorted(previous - current):
+            path = dst.joinpath(rel)
+            if os.path.lexists(path) and not path.is_dir():
+                os.unlink(path)
+
+        with open(manifest, "w") as f:
+            json.dump(sorted(current), f)
+        return copied
+
+
+def _unchanged(src, dst):
+    """Check whether dst is a copy of src made by copy2."""
+    try:
+        a = os.lstat(src)
+        b = os.lstat(dst)
+    except FileNotFoundError:
+        return False
+    if os.path.islink(src):
+        return os.path.islink(dst) and \
+            os.readlink(src) == os.readlink(dst)
+    return a.st_mode == b.st_mode and a.st_size == b.st_size and \
+        a.st_mtime_ns == b.st_mtime_ns
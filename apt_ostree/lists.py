@@ -0,0 +1,107 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+from apt_ostree.utils import get_cache_dir
+
+# Package caches apt derives from the lists, relative to /var/cache/apt.
+BINARY_CACHES = ["pkgcache.bin", "srcpkgcache.bin"]
+
+
+class ListsCache:
+    """apt package lists kept in the workspace between transactions.
+
+    Entries live in <workspace>/cache/lists/<key>, where the key is a hash
+    of the sources.list configuration of the tree, so every checkout with
+    the same feeds shares one copy of the indexes.
+    """
+
+    def __init__(self, state):
+        self.logging = logging.getLogger(__name__)
+        self.state = state
+        self.max_age = self.state.apt_lists_max_age
+        self.cachedir = get_cache_dir(self.state, "lists")
+
+    def key(self, rootfs):
+        """Hash the apt sources configured in a tree."""
+        m = hashlib.sha256()
+        etc = rootfs.joinpath("etc/apt")
+        sources = [etc.joinpath("sources.list")]
+        sources += sorted(etc.glob("sources.list.d/*"))
+        for path in sources:
+            if not path.is_file():
+                continue
+            m.update(path.name.encode("utf-8") + b"\0")
+            m.update(path.read_bytes())
+        return m.hexdigest()
+
+    def age(self, key):
+        """Seconds since the lists for key were updated, or None."""
+        try:
+            updated = float(
+                self.cachedir.joinpath(key, "updated").read_text())
+        except (OSError, ValueError):
+            return None
+        return time.time() - updated
+
+    def restore(self, key, rootfs):
+        """Copy the cached lists for key into a tree."""
+        entry = self.cachedir.joinpath(key)
+        lists = rootfs.joinpath("var/lib/apt/lists")
+        lists.mkdir(parents=True, exist_ok=True)
+        for path in entry.joinpath("lists").iterdir():
+            _link_or_copy(path, lists.joinpath(path.name))
+        for name in BINARY_CACHES:
+            path = entry.joinpath(name)
+            if path.exists():
+                shutil.copy2(path, rootfs.joinpath("var/cache/apt", name))
+
+    def save(self, key, rootfs):
+        """Replace the cached lists for key with the ones in a tree."""
+        entry = self.cachedir.joinpath(key)
+        tmp = self.cachedir.joinpath(f"{key}.tmp-{os.getpid()}")
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.joinpath("lists").mkdir(parents=True)
+
+        for path in rootfs.joinpath("var/lib/apt/lists").iterdir():
+            # Skip the lock and the partial/ download directory.
+            if path.is_file() and path.name != "lock":
+                _link_or_copy(path, tmp.joinpath("lists", path.name))
+        for name in BINARY_CACHES:
+            path = rootfs.joinpath("var/cache/apt", name)
+            if path.exists():
+                shutil.copy2(path, tmp.joinpath(name))
+        tmp.joinpath("updated").write_text(str(time.time()))
+
+        if entry.exists():
+            old = self.cachedir.joinpath(f"{key}.old-{os.getpid()}")
+            os.rename(entry, old)
+            shutil.rmtree(old)
+        os.rename(tmp, entry)
+
+
+def _link_or_copy(src, dst):
+    """Hardlink src to dst, copying when they are on different devices.
+
+    apt replaces list files by renaming new ones into place, so sharing
+    them between trees with hardlinks is safe.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(src, dst)
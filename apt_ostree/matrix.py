@@ -0,0 +1,143 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from rich.console import Console
+from rich.table import Table
+
+from apt_ostree.bootstrap import Bootstrap
+from apt_ostree.ostree import Ostree
+
+
+class BuildMatrix:
+    """Bootstrap several branches in parallel.
+
+    Every configuration directory below the base directory that holds a
+    bootstrap.yaml is a branch named after its path, e.g. debian/bookworm.
+    Each branch is built by a worker process in its own workspace under
+    <workspace>/branches, while the caches in <workspace>/cache, such as
+    downloaded packages, are shared by all of them.
+    """
+
+    def __init__(self, state):
+        self.logging = logging.getLogger(__name__)
+        self.console = Console()
+        self.state = state
+
+    def find_branches(self):
+        """Branches of the configurations below the base directory."""
+        return sorted(
+            str(config.parent.relative_to(self.state.base))
+            for config in self.state.base.rglob("bootstrap.yaml"))
+
+    def build(self, branches=None, jobs=None, cpus=None, memory=None,
+              use_cache=True, incremental=True):
+        """Bootstrap branches with up to jobs worker processes.
+
+        cpus is the number of CPUs each worker may run on and memory the
+        limit of its address space in bytes.
+        """
+        if not branches:
+            branches = self.find_branches()
+        if len(branches) == 0:
+            self.logging.error(
+                f"No bootstrap.yaml found in {self.state.base}.")
+            sys.exit(1)
+        cpu_count = os.cpu_count() or 1
+        if jobs is None:
+            jobs = max(1, cpu_count // (cpus or 1))
+        jobs = min(jobs, len(branches))
+
+        # Hand out disjoint CPU sets to the running workers.
+        manager = multiprocessing.Manager()
+        slots = manager.Queue()
+        for slot in range(jobs):
+            if cpus:
+                slots.put({(slot * cpus + i) % cpu_count
+                           for i in range(cpus)})
+            else:
+                slots.put(None)
+
+        # Create the repository up front so the workers do not race to
+        # create it.
+        Ostree(self.state).init()
+        self.logging.info(
+            f"Building {len(branches)} branches with {jobs} workers.")
+        results = {}
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {
+                pool.submit(_build_branch, self._branch_state(branch),
+                            slots, memory, use_cache, incremental): branch
+                for branch in branches}
+            for future in as_completed(futures):
+                branch = futures[future]
+                results[branch] = future.result()
+                if results[branch]["rev"] is None:
+                    self.logging.error(f"Failed to build {branch}.")
+                else:
+                    self.logging.info(f"Built {branch}.")
+        manager.shutdown()
+
+        self.report(results)
+        if any(r["rev"] is None for r in results.values()):
+            sys.exit(1)
+
+    def _branch_state(self, branch):
+        """State of a worker, with its own workspace."""
+        state = copy.copy(self.state)
+        state.branch = branch
+        state.base = self.state.base.joinpath(branch)
+        state.workspace = self.state.workspace.joinpath(
+            "branches", branch.replace("/", "_"))
+        state.cache_dir = self.state.cache_dir or \
+            self.state.workspace.joinpath("cache")
+        return state
+
+    def report(self, results):
+        table = Table(box=None)
+        table.add_column("Branch")
+        table.add_column("Commit")
+        table.add_column("Time (s)", justify="right")
+        for branch, result in sorted(results.items()):
+            table.add_row(branch,
+                          (result["rev"] or "failed")[:10],
+                          f"{result['elapsed']:.0f}")
+        self.console.print(table)
+
+
+def _build_branch(state, slots, memory, use_cache, incremental):
+    """Worker process building a single branch."""
+    slot = slots.get()
+    start = time.monotonic()
+    try:
+        if slot:
+            os.sched_setaffinity(0, slot)
+        if memory:
+            # Inherited by bdebstrap and the other commands it runs.
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        state.workspace.mkdir(parents=True, exist_ok=True)
+        Bootstrap(state).create_rootfs(use_cache=use_cache,
+                                       incremental=incremental)
+        _, rev = Ostree(state).open_ostree().resolve_rev(state.branch, True)
+    except SystemExit:
+        # Errors have already been logged.
+        rev = None
+    except Exception as e:
+        logging.getLogger(__name__).error(f"{state.branch}: {e}")
+        rev = None
+    finally:
+        slots.put(slot)
+    return {"rev": rev, "elapsed": time.monotonic() - start}
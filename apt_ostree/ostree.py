@@ -5,12 +5,22 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import fcntl
 import logging
+import os
+import pathlib
+import stat
 import subprocess
 import sys
+import time
 
 from rich.console import Console
 
+from apt_ostree import dpkg
+from apt_ostree.progress import PullProgress
+from apt_ostree.utils import get_cache_dir
 from apt_ostree.utils import run_command
 
 # pylint: disable=wrong-import-position
@@ -22,12 +32,18 @@ from gi.repository.GLib import Variant, VariantDict  # noqa:H301
 # Using AT_FDCWD value from fcntl.h
 AT_FDCWD = -100
 
+# Repository of the running system.
+SYSTEM_REPO = "/ostree/repo"
+
 
 class Ostree:
     def __init__(self, state):
         self.logging = logging.getLogger(__name__)
         self.state = state
         self.console = Console()
+        # Filled in by hardlinked checkouts so that committing the same
+        # tree can skip checksumming files that were not replaced.
+        self.devino_cache = OSTree.RepoDevInoCache.new()
 
     def init(self):
         """Create a new ostree repo."""
@@ -36,17 +52,20 @@ class Ostree:
         mode = OSTree.RepoMode.ARCHIVE_Z2
 
         try:
-            repo.create(mode)
+            with self.repo_lock():
+                repo.create(mode)
             self.console.print("Sucessfully initialized ostree repository.")
         except GLib.GError as e:
             self.logging.error(f"Failed to create repo: {e}")
             sys.exit(1)
 
-    def ostree_pull(self, repo_dir):
+    def ostree_pull(self, repo_dir, branch=None):
         """Copy a branch from an existing repo into a new repo."""
+        if branch is None:
+            branch = self.state.branch
         return run_command(
             ["ostree", "pull-local", f"--repo={repo_dir}",
-             str(self.state.repo), str(self.state.branch)],
+             str(self.state.repo or SYSTEM_REPO), str(branch)],
             check=True
         )
 
@@ -56,27 +75,301 @@ class Ostree:
                       branch=None,
                       subject=None,
                       parent=None,
-                      msg=None):
-        """Commit rootfs to ostree repository."""
-        cmd = ["ostree", "commit"]
-        if repo:
-            cmd += [f"--repo={repo}"]
-        if subject:
-            cmd += [f"--subject={subject}"]
-        if msg:
-            cmd += [f"--body={msg}"]
-
-        if branch:
-            cmd += [f"--branch={branch}"]
-        if parent:
-            cmd += [f"--parent={parent}"]
-        cmd += [str(root)]
-        r = run_command(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if r.returncode != 0:
-            self.logging.error("Failed to commit to tree.")
+                      msg=None,
+                      metadata=None,
+                      consume=False):
+        """Commit rootfs to ostree repository.
+
+        metadata is a dict of GLib.Variant values stored with the commit.
+        With consume, files are moved into the repository where possible
+        and unlinked from root as they are committed, like
+        ostree commit --consume. Returns the new commit checksum and the
+        transaction statistics.
+        """
+        repo = self.open_repo(repo)
+        if parent is None:
+            _, parent = repo.resolve_rev(branch, True)
+
+        flags = OSTree.RepoCommitModifierFlags.NONE
+        if consume:
+            flags |= OSTree.RepoCommitModifierFlags.CONSUME
+        modifier = OSTree.RepoCommitModifier.new(flags, None)
+        modifier.set_devino_cache(self.devino_cache)
+        try:
+            repo.prepare_transaction()
+            mtree = OSTree.MutableTree.new()
+            repo.write_dfd_to_mtree(
+                AT_FDCWD, str(root), mtree, modifier)
+            stats = self._finish_commit(
+                repo, mtree, parent, branch, subject, msg, metadata)
+        except GLib.GError as e:
+            repo.abort_transaction()
+            self.logging.error(f"Failed to commit to {branch}: {e.message}")
             sys.exit(1)
         self.logging.info(f"Sucessfully commited to {branch}.")
-        return r
+        return stats
+
+    def _finish_commit(self, repo, mtree, parent, branch, subject, msg,
+                       metadata=None):
+        """Write the commit for a mutable tree and move the branch to it.
+
+        Like ostree commit, the commit is bound to the branch so clients
+        can refuse it when it is served under another ref.
+        """
+        metadata = dict(metadata or {})
+        metadata[OSTree.COMMIT_META_KEY_REF_BINDING] = GLib.Variant(
+            "as", [branch])
+        metadata = GLib.Variant("a{sv}", metadata)
+        _, root = repo.write_mtree(mtree)
+        _, rev = repo.write_commit(parent, subject, msg, metadata, root)
+        with self.repo_lock(repo.get_path().get_path()):
+            repo.transaction_set_ref(None, branch, rev)
+            _, stats = repo.commit_transaction()
+        self.logging.debug(
+            f"Commit {rev[:10]}: wrote {stats.content_objects_written} of "
+            f"{stats.content_objects_total} files "
+            f"({stats.content_bytes_written} bytes) and "
+            f"{stats.metadata_objects_written} of "
+            f"{stats.metadata_objects_total} metadata objects.")
+        return {
+            "commit": rev,
+            "metadata_objects_total": stats.metadata_objects_total,
+            "metadata_objects_written": stats.metadata_objects_written,
+            "content_objects_total": stats.content_objects_total,
+            "content_objects_written": stats.content_objects_written,
+            "content_bytes_written": stats.content_bytes_written,
+        }
+
+    def commit_from(self, rev, branch, subject, msg, metadata=None):
+        """Commit the tree of rev as the new head of branch.
+
+        The commit keeps the metadata of rev, with metadata added, and
+        its parent is the current head of branch, so a tree built on
+        another ref reaches the branch without rewriting its history.
+        """
+        repo = self.open_ostree()
+        _, parent = repo.resolve_rev(branch, True)
+        try:
+            _, commit = repo.load_variant(OSTree.ObjectType.COMMIT, rev)
+            values = {}
+            old = commit.get_child_value(0)
+            for i in range(old.n_children()):
+                entry = old.get_child_value(i)
+                values[entry.get_child_value(0).get_string()] = \
+                    entry.get_child_value(1).get_variant()
+            values.update(metadata or {})
+
+            repo.prepare_transaction()
+            mtree = OSTree.MutableTree.new_from_commit(repo, rev)
+            stats = self._finish_commit(
+                repo, mtree, parent, branch, subject, msg, values)
+        except GLib.GError as e:
+            repo.abort_transaction()
+            self.logging.error(f"Failed to commit to {branch}: {e.message}")
+            sys.exit(1)
+        return stats
+
+    def ostree_commit_overlay(self,
+                              upperdir,
+                              parent,
+                              branch,
+                              subject=None,
+                              msg=None,
+                              metadata=None):
+        """Commit the changes held in an overlayfs upper directory.
+
+        Only the paths present in upperdir are written, on top of the
+        root directory of the parent commit. Whiteouts and opaque
+        directories are turned into removals from the parent tree.
+        """
+        repo = self.open_ostree()
+        try:
+            repo.prepare_transaction()
+            mtree = OSTree.MutableTree.new_from_commit(repo, parent)
+            self._apply_whiteouts(str(upperdir), mtree)
+
+            modifier = OSTree.RepoCommitModifier.new(
+                OSTree.RepoCommitModifierFlags.NONE, _overlay_filter)
+            modifier.set_xattr_callback(_overlay_xattrs, str(upperdir))
+            repo.write_directory_to_mtree(
+                Gio.File.new_for_path(str(upperdir)), mtree, modifier)
+            stats = self._finish_commit(
+                repo, mtree, parent, branch, subject, msg, metadata)
+        except GLib.GError as e:
+            repo.abort_transaction()
+            self.logging.error(f"Failed to commit to {branch}: {e.message}")
+            sys.exit(1)
+        self.logging.info(f"Sucessfully commited to {branch}.")
+        return stats
+
+    def package_metadata(self, rootfs):
+        """Commit metadata recording the packages installed in rootfs."""
+        return {
+            dpkg.MANIFEST_VERSION_KEY: GLib.Variant(
+                "u", dpkg.MANIFEST_VERSION),
+            dpkg.MANIFEST_KEY: GLib.Variant(
+                "a(sssbt)", dpkg.manifest(rootfs)),
+        }
+
+    def string_metadata(self, values):
+        """Commit metadata holding the strings of a dict."""
+        return {key: GLib.Variant("s", value)
+                for key, value in values.items()}
+
+    def read_metadata(self, rev, key):
+        """Read a metadata value of a commit, or None if it is unset."""
+        repo = self.open_ostree()
+        try:
+            _, commit = repo.load_variant(OSTree.ObjectType.COMMIT, rev)
+        except GLib.GError as e:
+            self.logging.error(f"Failed to load {rev[:10]}: {e.message}")
+            sys.exit(1)
+        metadata = VariantDict.new(commit.get_child_value(0))
+        value = metadata.lookup_value(key, None)
+        if value is None:
+            return None
+        return value.unpack()
+
+    def ref_bindings(self, rev):
+        """Branches a commit is bound to, see _finish_commit()."""
+        return self.read_metadata(
+            rev, OSTree.COMMIT_META_KEY_REF_BINDING) or []
+
+    def read_manifest(self, rev):
+        """Read the package manifest stored with a commit.
+
+        Returns None for commits made without a manifest.
+        """
+        version = self.read_metadata(rev, dpkg.MANIFEST_VERSION_KEY)
+        if version != dpkg.MANIFEST_VERSION:
+            return None
+        return self.read_metadata(rev, dpkg.MANIFEST_KEY)
+
+    def installed_packages(self, rev):
+        """Names of the packages installed in a commit."""
+        manifest = self.read_manifest(rev)
+        if manifest is not None:
+            return {pkg[0] for pkg in manifest}
+        status = self.read_commit_file(rev, dpkg.STATUS)
+        return dpkg.installed_packages(dpkg.parse_status(status))
+
+    def _apply_whiteouts(self, path, mtree):
+        """Remove the paths hidden by overlayfs from a mutable tree."""
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    _, checksum, subdir = mtree.lookup(entry.name)
+                except GLib.GError:
+                    # New in the upper directory.
+                    continue
+
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISCHR(st.st_mode) and st.st_rdev == 0:
+                    mtree.remove(entry.name, True)
+                elif stat.S_ISDIR(st.st_mode):
+                    if _is_opaque(entry.path) or subdir is None:
+                        mtree.remove(entry.name, True)
+                    else:
+                        self._apply_whiteouts(entry.path, subdir)
+                elif subdir is not None:
+                    # A file replaced a directory.
+                    mtree.remove(entry.name, True)
+
+    def update_static_deltas(self, branch):
+        """Generate the static deltas configured for compose commits."""
+        if not self.state.repo:
+            return
+        if self.state.static_deltas == 0 and \
+           not self.state.static_delta_from_empty:
+            return
+        self.generate_static_deltas(
+            branch, self.state.static_deltas,
+            from_empty=self.state.static_delta_from_empty)
+
+    def generate_static_deltas(self, branch, depth, from_empty=False):
+        """Generate static deltas to the head of a branch.
+
+        A delta is generated from each of the depth previous commits of
+        the branch that are in the repository, and from an empty tree
+        when from_empty is set. The deltas are computed in parallel by
+        separate ostree processes, then the summary is regenerated.
+        """
+        repo = self.open_ostree()
+        rev = self.resolve_rev(branch)
+        sources = self._ancestors(repo, rev, depth)
+        if from_empty:
+            sources.append(None)
+        if len(sources) == 0:
+            self.logging.info(f"No previous commits of {branch}.")
+            return
+
+        self.logging.info(
+            f"Generating {len(sources)} static deltas to {rev[:10]}.")
+        workers = min(len(sources), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(
+                lambda source: self._static_delta(source, rev), sources))
+        if not all(results):
+            self.logging.error("Failed to generate static deltas.")
+            sys.exit(1)
+
+        try:
+            with self.repo_lock():
+                repo.regenerate_summary(None, None)
+        except GLib.GError as e:
+            self.logging.error(f"Failed to update summary: {e.message}")
+            sys.exit(1)
+
+    def _ancestors(self, repo, rev, depth):
+        """Up to depth parents of a commit present in the repository."""
+        ancestors = []
+        while len(ancestors) < depth:
+            _, commit = repo.load_variant(OSTree.ObjectType.COMMIT, rev)
+            rev = OSTree.commit_get_parent(commit)
+            if rev is None:
+                break
+            if not self.has_commit(rev):
+                # History was pruned or pulled with a limited depth.
+                break
+            ancestors.append(rev)
+        return ancestors
+
+    def _static_delta(self, source, rev):
+        """Run ostree to generate one delta; source None means empty."""
+        cmd = ["ostree", "static-delta", "generate",
+               f"--repo={self.state.repo}", "--if-not-exists",
+               f"--to={rev}"]
+        if source is None:
+            cmd.append("--empty")
+        else:
+            cmd.append(f"--from={source}")
+        r = run_command(cmd, stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT, check=False)
+        if r is None:
+            return False
+        if r.returncode != 0:
+            name = "empty" if source is None else source[:10]
+            output = r.stdout.decode("utf-8", errors="replace").strip()
+            self.logging.warning(f"Delta {name}-{rev[:10]} failed: {output}")
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def repo_lock(self, path=None):
+        """Serialize ref and summary updates of a repository.
+
+        Objects can be written by several apt-ostree processes at once,
+        but branch updates are made one at a time. path defaults to the
+        compose repository.
+        """
+        path = pathlib.Path(path) if path else self.state.repo
+        if not path:
+            yield
+            return
+        path.mkdir(parents=True, exist_ok=True)
+        with open(path.joinpath(".apt-ostree.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
 
     def get_sysroot(self):
         """Load the /ostree directory (sysroot)."""
@@ -103,47 +396,121 @@ class Ostree:
                 sys.exit(1)
         return repo
 
+    def open_repo(self, path=None):
+        """Open the repository at path, defaulting to open_ostree()."""
+        if path is None or str(path) == str(self.state.repo):
+            return self.open_ostree()
+        repo = OSTree.Repo.new(Gio.File.new_for_path(str(path)))
+        try:
+            repo.open(None)
+        except GLib.GError as e:
+            self.logging.error(f"Failed to open {path}: {e.message}")
+            sys.exit(1)
+        return repo
+
+    def open_checkout_repo(self, branch):
+        """Open a bare repository to check out staging trees from.
+
+        A bare repository stores files uncompressed, so a checkout only
+        creates directory entries pointing into the object store when
+        hardlinking, or copies the files without decompressing them,
+        sharing their data with reflinks where the filesystem supports
+        it. The branch is mirrored into a bare cache repository in the
+        workspace, even when the source repository is bare, so that the
+        repository of the system is never hardlinked to.
+        """
+        path = get_cache_dir(self.state, "repo")
+        cache = OSTree.Repo.new(Gio.File.new_for_path(str(path)))
+        try:
+            # Creating an existing repo just opens it.
+            cache.create(OSTree.RepoMode.BARE)
+        except GLib.GError as e:
+            self.logging.error(f"Failed to create cache repo: {e}")
+            sys.exit(1)
+
+        self.logging.debug(f"Mirroring {branch} into {path}.")
+        self.ostree_pull(path, branch=branch)
+        return cache
+
     def fetch(self, remote, branch, progress=None):
-        """Fetch an object from a remote repository."""
+        """Fetch an object from a remote repository.
+
+        The pull is tuned by the fetch options of the state: commit
+        depth, static delta use, network retries, commit-only pulls and
+        local repositories to copy objects from.
+        """
         cancellable = None
         progress = OSTree.AsyncProgress.new()
-        progress.connect('changed', self._progress_cb)
+        renderer = PullProgress(self.state)
+        progress.connect('changed', renderer.changed)
 
         repo = self.open_ostree()
 
+        flags = OSTree.RepoPullFlags.NONE
+        if self.state.commit_metadata_only:
+            flags |= OSTree.RepoPullFlags.COMMIT_ONLY
+
         # Pull Options
         pull_options = {
-            'depth': GLib.Variant('i', -1),
+            'depth': GLib.Variant('i', self.state.fetch_depth),
             'refs': GLib.Variant('as', (branch,)),
+            'flags': GLib.Variant('i', int(flags)),
+            'n-network-retries': GLib.Variant(
+                'u', self.state.network_retries),
         }
+        if self.state.fetch_deltas == "disable":
+            pull_options['disable-static-deltas'] = GLib.Variant('b', True)
+        elif self.state.fetch_deltas == "require":
+            pull_options['require-static-deltas'] = GLib.Variant('b', True)
+        if self.state.localcache_repos:
+            pull_options['localcache-repos'] = GLib.Variant(
+                'as', [str(r) for r in self.state.localcache_repos])
+
+        start = time.monotonic()
         try:
-            repo.pull_with_options(remote,
-                                   GLib.Variant('a{sv}', pull_options),
-                                   progress, cancellable)
+            with renderer:
+                repo.pull_with_options(remote,
+                                       GLib.Variant('a{sv}', pull_options),
+                                       progress, cancellable)
         except GLib.GError as e:
             self.logging.error(f"Fetch failed: {e.message}")
             sys.exit(1)
+        finally:
+            progress.finish()
+        elapsed = time.monotonic() - start
 
-    def _progress_cb(self, async_progress):
-        """Show whats happening."""
-        status = async_progress.get_status()
-        outstanding_fetches = async_progress.get_uint('outstanding-fetches')
-        if status:
-            print(f'OUTPUT:Status: {status}')
-        elif outstanding_fetches > 0:
-            fetched = async_progress.get_uint('fetched')
-            requested = async_progress.get_uint('requested')
-            if requested == 0:
-                percent = 0.0
-            else:
-                percent = fetched / requested
-            print(f'PROGRESS:{percent}')
-
-    def ostree_checkout(self, branch, rootfs):
-        """Checkout a branch from an ostree repository."""
-        repo = self.open_ostree()
+        stats = {
+            "bytes_transferred": progress.get_uint64('bytes-transferred'),
+            "objects_fetched": progress.get_uint('fetched'),
+            "metadata_fetched": progress.get_uint('metadata-fetched'),
+            "delta_parts_fetched": progress.get_uint('fetched-delta-parts'),
+            "elapsed": elapsed,
+        }
+        self.logging.info(
+            f"Fetched {branch} from {remote}: "
+            f"{stats['bytes_transferred']} bytes, "
+            f"{stats['objects_fetched']} objects "
+            f"({stats['metadata_fetched']} metadata), "
+            f"{stats['delta_parts_fetched']} delta parts "
+            f"in {elapsed:.1f}s.")
+        return stats
+
+    def ostree_checkout(self, branch, rootfs, repo=None, copy=False):
+        """Checkout a branch from an ostree repository.
+
+        When repo is a bare repository on the same filesystem as rootfs,
+        files are hardlinked to the repository objects unless copy is
+        set. Writing to such a file in place changes the object, so
+        hardlinked trees must only be read, like overlay lower layers.
+        """
+        if repo is None:
+            repo = self.open_ostree()
         ret, rev = repo.resolve_rev(branch, True)
         opts = OSTree.RepoCheckoutAtOptions()
+        if copy:
+            opts.force_copy = True
+        else:
+            opts.devino_to_csum_cache = self.devino_cache
         if rev:
             try:
                 repo.checkout_at(opts, AT_FDCWD, str(rootfs), rev, None)
@@ -151,6 +518,52 @@ class Ostree:
                 self.logging.error(f"Failed to checkout {rev}: {e.message}")
                 raise
 
+    def read_commit_file(self, rev, path):
+        """Read a file from a commit without checking it out.
+
+        Yields the content of the file in chunks.
+        """
+        repo = self.open_ostree()
+        try:
+            _, root, _ = repo.read_commit(rev, None)
+            stream = root.resolve_relative_path(path).read(None)
+            while True:
+                data = stream.read_bytes(1 << 16, None).get_data()
+                if not data:
+                    break
+                yield data
+            stream.close(None)
+        except GLib.GError as e:
+            self.logging.error(
+                f"Failed to read {path} from {rev[:10]}: {e.message}")
+            sys.exit(1)
+
+    def resolve_rev(self, ref):
+        """Resolve a branch or commit to a commit checksum."""
+        repo = self.open_ostree()
+        try:
+            _, rev = repo.resolve_rev(ref, False)
+        except GLib.GError as e:
+            self.logging.error(f"{ref} does not exist: {e.message}")
+            sys.exit(1)
+        return rev
+
+    def has_commit(self, rev):
+        """Check that a commit is in the repository."""
+        repo = self.open_ostree()
+        ok, _ = repo.has_object(OSTree.ObjectType.COMMIT, rev, None)
+        return ok
+
+    def set_ref(self, branch, rev):
+        """Point a branch at an existing commit."""
+        repo = self.open_ostree()
+        try:
+            with self.repo_lock():
+                repo.set_ref_immediate(None, branch, rev, None)
+        except GLib.GError as e:
+            self.logging.error(f"Failed to update {branch}: {e.message}")
+            sys.exit(1)
+
     def ostree_ref(self, branch):
         """Find the commit id for a given reference."""
         repo = self.open_ostree()
@@ -242,3 +655,32 @@ class Ostree:
         except GLib.GError as e:
             self.logging.error(f"Failed to fetch refs: {e}")
             sys.exit(1)
+
+
+def _is_opaque(path):
+    """Check for an overlayfs directory that hides the lower layers."""
+    try:
+        return os.getxattr(path, "trusted.overlay.opaque",
+                           follow_symlinks=False) == b"y"
+    except OSError:
+        return False
+
+
+def _overlay_filter(repo, path, file_info, *args):
+    """Skip overlayfs whiteouts, which are 0/0 character devices."""
+    if file_info.get_file_type() == Gio.FileType.SPECIAL and \
+       file_info.get_attribute_uint32("unix::rdev") == 0:
+        return OSTree.RepoCommitFilterResult.SKIP
+    return OSTree.RepoCommitFilterResult.ALLOW
+
+
+def _overlay_xattrs(repo, path, file_info, upperdir):
+    """Read xattrs from the upper directory, dropping overlayfs ones."""
+    path = os.path.join(upperdir, path.lstrip("/"))
+    xattrs = []
+    for name in os.listxattr(path, follow_symlinks=False):
+        if name.startswith("trusted.overlay."):
+            continue
+        value = os.getxattr(path, name, follow_symlinks=False)
+        xattrs.append((name.encode("utf-8") + b"\0", value))
+    return GLib.Variant("a(ayay)", xattrs)
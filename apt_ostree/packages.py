@@ -11,6 +11,7 @@ import sys
 from rich.console import Console
 
 from apt_ostree.apt import Apt
+from apt_ostree.bootstrap import Bootstrap
 from apt_ostree.deploy import Deploy
 from apt_ostree.ostree import Ostree
 
@@ -23,13 +24,10 @@ class Packages:
         self.apt = Apt(self.state)
         self.ostree = Ostree(self.state)
         self.deploy = Deploy(self.state)
+        self.bootstrap = Bootstrap(self.state)
 
     def install(self, packages):
         """Use apt to install Debian packages."""
-        deps = set()
-        predeps = set()
-        all_deps = set()
-
         branch = self.ostree.get_branch()
         rootfs = self.deploy.get_sysroot()
         if not rootfs.exists():
@@ -49,43 +47,66 @@ class Packages:
             self.logging.error("No valid packages found.")
             sys.exit(1)
 
-        # Step 3 - Generate the commit message.
+        # Step 3 - Resolve the install set and generate the commit
+        #          message.
+        resolved = self.apt.resolve(cache, packages)
+        versions = resolved["packages"]
         commit = "New packages installed: \n\n"
         for pkg in packages:
             version = self.apt.get_version(cache, pkg)
             commit += f"- {pkg} ({version})\n"
 
-        deps = self.apt.get_dependencies(
-            cache, packages, deps, predeps, all_deps)
+        deps = sorted(set(versions) - set(packages))
         if len(deps) == 0:
             commit += "\nNo new dependencies found."
         else:
             commit += "\nNew Dependencies: \n\n"
             for dep in deps:
-                version = self.apt.get_version(cache, dep)
-                commit += f"- {dep} ({version})\n"
+                commit += f"- {dep} ({versions[dep]})\n"
+        commit += f"\nDownload size: {resolved['download_size']} bytes\n"
+        commit += f"Installed size: {resolved['installed_size']} bytes\n"
 
-        # Step 4 - Install the valid packages.
-        self.apt.apt_install(cache, packages, rootfs)
+        # Step 4 - Download and install the valid packages.
+        offline = self.prefetch(cache)
+        self.apt.apt_install(cache, packages, rootfs, offline=offline)
+        self.bootstrap.create_tmpfile_dir(rootfs, packages=versions.keys())
 
         # Step 5 - Run post staging steps.
         self.deploy.poststaging(rootfs)
 
         # Step 6 - Ostree commit.
         self.logging.info(f"Commiting to {branch}")
-        self.ostree.ostree_commit(
-            root=str(rootfs),
+        rev = self.deploy.commit(
+            rootfs,
             branch=self.ostree.get_branch(),
-            repo=self.state.repo,
             subject="New packages",
             msg=commit,
         )
 
         # Step 7 - Cleanup
-        self.deploy.cleanup(rootfs)
-
-    def upgrade(self):
-        """Use apt to install Debian packages."""
+        self.deploy.cleanup(rootfs, rev=rev)
+
+    def prefetch(self, cache):
+        """Download the archives for the changes marked in cache.
+
+        Returns True when apt can run without downloading anything.
+        """
+        changes = cache.get_changes()
+        if len(changes) == 0:
+            return False
+        offline = self.apt.archives.prefetch(
+            changes, workers=self.state.fetch_workers)
+        if not offline:
+            self.logging.warning(
+                "Prefetch incomplete, apt will download the rest.")
+        return offline
+
+    def upgrade(self, download_only=False):
+        """Use apt to install Debian packages.
+
+        With download_only, the upgrade is only downloaded into the
+        package cache and nothing is committed.
+        """
         rootfs = self.deploy.get_sysroot()
         if not rootfs.exists():
             self.logging.error("Unable to determine rootfs: {rootfs}")
@@ -107,7 +128,8 @@ class Packages:
         # can check for any updates before doing anything
         # else.
         cache.upgrade(False)
-        packages = [package.name for package in cache.get_changes()]
+        changes = cache.get_changes()
+        packages = [package.name for package in changes]
         if len(packages) == 0:
             self.logging.error("No package to upgrade.")
             sys.exit(1)
@@ -127,7 +149,13 @@ class Packages:
                 commit += f"- {name} ({current} -> {update})\n"
 
         # Step 4 - Do the upgrade.
-        self.apt.apt_upgrade(rootfs)
+        offline = self.prefetch(cache)
+        if download_only:
+            self.logging.info("Upgrade downloaded, not installing.")
+            self.deploy.cleanup(rootfs)
+            return
+        self.apt.apt_upgrade(rootfs, changes, offline=offline)
+        self.bootstrap.create_tmpfile_dir(rootfs, packages=packages)
 
         # Step 5 - Poststaging.
         self.deploy.poststaging(rootfs)
@@ -136,16 +164,15 @@ class Packages:
         self.console.print(
             f"Commiting to {self.ostree.get_branch()}. Please wait",
             highlight=False)
-        self.ostree.ostree_commit(
-            root=str(rootfs),
+        rev = self.deploy.commit(
+            rootfs,
             branch=self.ostree.get_branch(),
-            repo=self.state.repo,
             subject="Package Upgrade",
             msg=commit,
         )
 
         # Step 7 - Cleanup
-        self.deploy.cleanup(rootfs)
+        self.deploy.cleanup(rootfs, rev=rev)
 
     def uninstall(self, packages):
         """Use apt to uninstall Debian packages."""
@@ -170,6 +197,7 @@ class Packages:
 
         # Step 4 - Uninstall the valid packages.
         self.apt.apt_uninstall(packages, rootfs)
+        self.bootstrap.create_tmpfile_dir(rootfs, packages=[])
 
         # Step 5 - Run poststaging steps.
         self.deploy.poststaging(rootfs)
@@ -179,13 +207,12 @@ class Packages:
             f"Commiting to {self.ostree.get_branch()}. Please wait",
             highlight=False)
 
-        self.ostree.ostree_commit(
-            root=str(rootfs),
+        rev = self.deploy.commit(
+            rootfs,
             branch=self.ostree.get_branch(),
-            repo=self.state.repo,
             subject="Uninstall packages",
             msg=commit,
         )
 
         # Step 7 - Cleanup
-        self.deploy.cleanup(rootfs)
+        self.deploy.cleanup(rootfs, rev=rev)
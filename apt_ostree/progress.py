@@ -0,0 +1,136 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import json
+import time
+
+import click
+from rich.console import Console
+from rich.progress import BarColumn
+from rich.progress import Progress
+from rich.progress import TaskProgressColumn
+from rich.progress import TextColumn
+
+
+class PullProgress:
+    """Render OSTree.AsyncProgress updates at a fixed rate.
+
+    libostree emits a changed signal for every object it fetches, so
+    the updates are only read and rendered once per interval. The
+    "rich" format draws a progress bar, "json" writes one JSON object
+    per update for automation and "none" stays silent.
+    """
+
+    def __init__(self, state, interval=0.5):
+        self.state = state
+        self.console = Console()
+        self.format = self.state.progress_format
+        self.interval = interval
+        self.start = None
+        self.last = 0
+        self.async_progress = None
+        self.progress = None
+        self.task = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        if self.format == "rich":
+            self.progress = Progress(
+                TextColumn("[progress.description]{task.description}"),
+                BarColumn(),
+                TaskProgressColumn(),
+                TextColumn("{task.fields[detail]}"),
+                console=self.console,
+                auto_refresh=False,
+                transient=True,
+            )
+            self.progress.start()
+            self.task = self.progress.add_task(
+                "Receiving objects", total=None, detail="")
+        return self
+
+    def __exit__(self, *exc):
+        if self.async_progress is not None:
+            self.render(self.read(self.async_progress))
+        if self.progress is not None:
+            self.progress.stop()
+
+    def changed(self, async_progress):
+        """Handler for the changed signal of OSTree.AsyncProgress."""
+        self.async_progress = async_progress
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        self.render(self.read(async_progress))
+
+    def read(self, async_progress):
+        """Collect the progress keys libostree exposes for a pull."""
+        p = async_progress
+        status = {
+            "status": p.get_status() or "",
+            "fetched": p.get_uint("fetched"),
+            "requested": p.get_uint("requested"),
+            "metadata_fetched": p.get_uint("metadata-fetched"),
+            "outstanding_fetches": p.get_uint("outstanding-fetches"),
+            "bytes_transferred": p.get_uint64("bytes-transferred"),
+            "delta_parts_fetched": p.get_uint("fetched-delta-parts"),
+            "delta_parts_total": p.get_uint("total-delta-parts"),
+            "delta_bytes_fetched": p.get_uint64("fetched-delta-part-size"),
+            "delta_bytes_total": p.get_uint64("total-delta-part-size"),
+        }
+        elapsed = time.monotonic() - self.start
+        status["elapsed"] = round(elapsed, 1)
+        status["bytes_per_second"] = \
+            int(status["bytes_transferred"] / elapsed) if elapsed else 0
+        status["eta"] = self._eta(status)
+        return status
+
+    def _eta(self, status):
+        """Seconds until the pull completes, or None if unknown."""
+        rate = status["bytes_per_second"]
+        if rate == 0:
+            return None
+        if status["delta_bytes_total"]:
+            remaining = status["delta_bytes_total"] - \
+                status["delta_bytes_fetched"]
+        elif status["fetched"] and status["requested"]:
+            # Assume the remaining objects have the average size.
+            per_object = status["bytes_transferred"] / status["fetched"]
+            remaining = (status["requested"] - status["fetched"]) * \
+                per_object
+        else:
+            return None
+        return int(max(remaining, 0) / rate)
+
+    def render(self, status):
+        if self.format == "json":
+            click.echo(json.dumps(status))
+        elif self.format == "rich":
+            detail = (f"{_size(status['bytes_transferred'])} "
+                      f"{_size(status['bytes_per_second'])}/s")
+            if status["delta_parts_total"]:
+                detail += (f" delta parts {status['delta_parts_fetched']}/"
+                           f"{status['delta_parts_total']}")
+            if status["eta"] is not None:
+                detail += f" ETA {status['eta']}s"
+            self.progress.update(
+                self.task,
+                description=status["status"] or "Receiving objects",
+                completed=status["fetched"],
+                total=status["requested"] or None,
+                detail=detail)
+            self.progress.refresh()
+
+
+def _size(n):
+    """Format a byte count for display."""
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if n < 1024:
+            return f"{n:.1f} {unit}" if unit != "B" else f"{n} B"
+        n /= 1024
+    return f"{n:.1f} TiB"
@@ -39,10 +39,14 @@ class Rebase:
             self.logging.error("No remotes configured.")
             sys.exit(1)
 
+        if self.state.commit_metadata_only and not update:
+            self.logging.error(
+                "--commit-metadata-only can only be used with --update.")
+            sys.exit(1)
+
         if update:
             self.logging.info(f"Pulling {branch} from {remote}.")
-            with self.console.status(f"Fetching {branch} from {remote}"):
-                self._fetch(remote, branch)
+            self._fetch(remote, branch)
             sys.exit(1)
         else:
             # Get the current deployment, check for
@@ -113,15 +117,14 @@ class Rebase:
             self.deploy.poststaging(rootfs)
 
             self.logging.info(f"Commiting to {self.state.branch}.")
-            self.ostree.ostree_commit(
-                root=str(rootfs),
+            rev = self.deploy.commit(
+                rootfs,
                 branch=self.state.branch,
-                repo=self.state.repo,
                 subject=subject,
                 msg=commit
             )
 
-            self.deploy.cleanup(rootfs)
+            self.deploy.cleanup(rootfs, rev=rev)
 
     def _get_remotes(self):
         """List of remotes configured."""
@@ -134,25 +137,11 @@ class Rebase:
         self.ostree.fetch(remote, branch)
 
     def get_current_packages(self, branch, ref):
-        """Steps to prepare the systeem before a rebase."""
-        self.logging.debug(
-            f"Deploying current deployment {branch} ({ref[:10]})")
-        rootfs = self.deploy.get_sysroot(branch)
-        if not rootfs.exists():
-            self.logging.error("Unable to determine rootfs: {rootfs}")
-            sys.exit(1)
-
-        # Deploy the current booted deployment and run apt-update
-        # to configure apt.
-        self.deploy.prestaging(rootfs)
-        self.apt.apt_update(rootfs)
-
-        # Check for packages that are installed.
-        self.logging.debug("Querying installed packages.")
-        cache = self.apt.cache(rootfs)
-        pkgs = self.apt.get_installed_packages(cache)
+        """Get the packages installed in the current deployment.
 
-        # Just remove the directory since we are done with it
-        self.deploy.cleanup(rootfs)
-
-        return pkgs
+        The package manifest or the dpkg database is read straight from
+        the commit, so the deployment does not have to be checked out.
+        """
+        self.logging.debug(
+            f"Querying installed packages in {branch} ({ref[:10]})")
+        return self.ostree.installed_packages(ref)
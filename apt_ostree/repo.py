@@ -145,16 +145,13 @@ class Repo:
         self.deploy.poststaging(rootfs)
 
         self.logging.info(f"Committing to {branch} to repo.")
-        r = self.ostree.ostree_commit(
-            root=str(rootfs),
+        rev = self.deploy.commit(
+            rootfs,
             branch=branch,
-            repo=self.state.repo,
             subject="Disabled package feed.",
             msg=f"Disabled {self.state.sources}",
         )
-        if r.returncode != 0:
-            self.logging.error("Failed to commit to repository.")
-        self.deploy.cleanup(str(rootfs))
+        self.deploy.cleanup(rootfs, rev=rev)
 
     def add_repo(self):
         """Enable Debian feed via apt-add-repository."""
@@ -181,13 +178,10 @@ class Repo:
         self.deploy.poststaging(rootfs)
 
         self.logging.info(f"Committing to {branch} to repo.")
-        r = self.ostree.ostree_commit(
-            root=str(rootfs),
+        rev = self.deploy.commit(
+            rootfs,
             branch=branch,
-            repo=self.state.repo,
             subject="Enable package feed.",
             msg=f"Enabled {self.state.sources}",
         )
-        if r.returncode != 0:
-            self.logging.error("Failed to commit to repository")
-        self.deploy.cleanup(str(rootfs))
+        self.deploy.cleanup(rootfs, rev=rev)
@@ -0,0 +1,243 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from apt_ostree.utils import get_cache_dir
+
+# File in a cached rootfs holding the marker of its entry.
+MARKER = ".apt-ostree-staging"
+
+
+class StagingCache:
+    """Pristine staging trees keyed by the commit they were checked out from.
+
+    Every entry lives in <workspace>/cache/staging/<rev> and holds the
+    rootfs together with an info.json file recording the commit, its
+    size, the last time it was used and a marker also written into the
+    rootfs when it is stored. Entries are evicted least recently used
+    first once the cache grows past its size cap. Processes sharing the
+    cache serialize on staging.lock next to it.
+    """
+
+    def __init__(self, state):
+        self.logging = logging.getLogger(__name__)
+        self.state = state
+        self.max_size = self.state.staging_cache_size
+        self.cachedir = None
+        if self.enabled():
+            self.cachedir = get_cache_dir(self.state, "staging")
+
+    def enabled(self):
+        """The cache is disabled unless a size cap is configured."""
+        return self.max_size > 0
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(self.cachedir.with_name("staging.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def lookup(self, rev):
+        """Return the cached rootfs of a commit, or None."""
+        if not self.enabled():
+            return None
+        with self._lock():
+            return self._lookup(rev)
+
+    def _lookup(self, rev):
+        entry = self.cachedir.joinpath(rev)
+        info = self._load_info(entry)
+        if info is None:
+            return None
+
+        rootfs = entry.joinpath("rootfs")
+        try:
+            marker = rootfs.joinpath(MARKER).read_text()
+        except OSError:
+            marker = None
+        if info.get("rev") != rev or marker != info.get("marker"):
+            self.logging.warning(
+                f"Discarding incomplete staging tree for {rev[:10]}.")
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+
+        info["last_used"] = time.time()
+        self._save_info(entry, info)
+        return rootfs
+
+    def take(self, rev, dest):
+        """Move the cached rootfs of a commit to dest.
+
+        Returns False if the commit is not cached.
+        """
+        if not self.enabled():
+            return False
+        with self._lock():
+            rootfs = self._lookup(rev)
+            if rootfs is None:
+                return False
+            try:
+                os.rename(rootfs, dest)
+            except FileNotFoundError:
+                # Removed by a process that did not wait for the lock.
+                return False
+            shutil.rmtree(self.cachedir.joinpath(rev), ignore_errors=True)
+
+        self.logging.info(f"Reusing staging tree for {rev[:10]}.")
+        os.unlink(dest.joinpath(MARKER))
+        return True
+
+    def store(self, rev, rootfs):
+        """Move a rootfs whose content matches commit rev into the cache."""
+        entry = self.cachedir.joinpath(rev)
+        tmp = self.cachedir.joinpath(f"{rev}.tmp-{os.getpid()}")
+        tmp.mkdir()
+        os.rename(rootfs, tmp.joinpath("rootfs"))
+        marker = uuid.uuid4().hex
+        tmp.joinpath("rootfs", MARKER).write_text(marker)
+        self._save_info(tmp, {
+            "rev": rev,
+            "size": self._disk_usage(tmp.joinpath("rootfs")),
+            "last_used": time.time(),
+            "marker": marker,
+        })
+        with self._lock():
+            if entry.exists():
+                shutil.rmtree(entry)
+            os.rename(tmp, entry)
+            self.logging.debug(f"Cached staging tree for {rev[:10]}.")
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under the size cap.
+
+        Called with the cache locked.
+        """
+        entries = []
+        for entry in self.cachedir.iterdir():
+            if ".tmp-" in entry.name:
+                # Leftover from an interrupted store.
+                pid = int(entry.name.rsplit("-", 1)[1])
+                if not os.path.exists(f"/proc/{pid}"):
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            info = self._load_info(entry)
+            if info is None:
+                shutil.rmtree(entry, ignore_errors=True)
+                continue
+            entries.append((info["last_used"], info["size"], entry))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_size:
+            _, size, entry = entries.pop(0)
+            self.logging.debug(f"Evicting staging tree {entry.name[:10]}.")
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def _load_info(self, entry):
+        try:
+            with open(entry.joinpath("info.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_info(self, entry, info):
+        tmp = entry.joinpath("info.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(info, f)
+        os.rename(tmp, entry.joinpath("info.json"))
+
+    def _disk_usage(self, rootfs):
+        """Bytes used by a tree, counting hardlinked files once."""
+        seen = set()
+        total = 0
+        for base, dirs, files in os.walk(rootfs):
+            for name in dirs + files:
+                st = os.lstat(os.path.join(base, name))
+                if st.st_ino in seen:
+                    continue
+                seen.add(st.st_ino)
+                total += st.st_blocks * 512
+        return total
+
+
+class OverlayCache:
+    """Read-only overlayfs lower layers, keyed by commit.
+
+    Every entry lives in <workspace>/cache/overlay/<rev>. A base entry
+    holds a full checkout of the commit. A layered entry holds the upper
+    directory of the transaction that created the commit and names its
+    parent commit, so back-to-back transactions stack their changes
+    instead of checking out the whole tree again.
+    """
+
+    # overlayfs supports more, but lookups get slower with every layer.
+    MAX_LAYERS = 16
+
+    def __init__(self, state):
+        self.logging = logging.getLogger(__name__)
+        self.state = state
+        self.cachedir = None
+        if self.state.staging == "overlay":
+            self.cachedir = get_cache_dir(self.state, "overlay")
+
+    def layer_path(self, rev):
+        """Directory holding the layer of a commit."""
+        return self.cachedir.joinpath(rev, "layer")
+
+    def lowerdirs(self, rev):
+        """Return the layers of a commit, topmost first, or None."""
+        layers = []
+        while rev:
+            entry = self.cachedir.joinpath(rev)
+            if not entry.joinpath("layer").exists():
+                return None
+            layers.append(entry.joinpath("layer"))
+            parent = entry.joinpath("parent")
+            rev = parent.read_text().strip() if parent.exists() else None
+        return layers
+
+    def add_layer(self, rev, parent, upperdir):
+        """Keep the upper directory of a committed transaction."""
+        lowers = self.lowerdirs(parent)
+        if lowers is None or len(lowers) >= self.MAX_LAYERS:
+            shutil.rmtree(upperdir)
+            return
+
+        entry = self.cachedir.joinpath(rev)
+        if entry.exists():
+            shutil.rmtree(entry)
+        entry.mkdir()
+        entry.joinpath("parent").write_text(parent)
+        os.rename(upperdir, entry.joinpath("layer"))
+
+    def prune(self, heads):
+        """Remove layers not needed by any of the given commits."""
+        live = set()
+        for rev in heads:
+            while rev and rev not in live:
+                entry = self.cachedir.joinpath(rev)
+                if not entry.exists():
+                    break
+                live.add(rev)
+                parent = entry.joinpath("parent")
+                rev = parent.read_text().strip() if parent.exists() else None
+
+        for entry in self.cachedir.iterdir():
+            if entry.name not in live:
+                self.logging.debug(
+                    f"Removing overlay layer {entry.name[:10]}.")
+                shutil.rmtree(entry, ignore_errors=True)
@@ -21,3 +21,26 @@ class TestComposeCLI(base.TestCase):
         runner = CliRunner()
         result = runner.invoke(cli, ["compose", "image", "--help"])
         assert result.exit_code == 0
+
+    def test_compose_diff(self):
+        runner = CliRunner()
+        result = runner.invoke(cli, ["compose", "diff", "--help"])
+        assert result.exit_code == 0
+
+    def test_compose_delta(self):
+        runner = CliRunner()
+        result = runner.invoke(cli, ["compose", "delta", "--help"])
+        assert result.exit_code == 0
+
+    def test_compose_create_requires_branch(self):
+        runner = CliRunner()
+        result = runner.invoke(
+            cli, ["compose", "create", "--repo", "repo", "--base", "config"])
+        assert result.exit_code == 2
+
+    def test_compose_create_treefile_single_branch(self):
+        runner = CliRunner()
+        result = runner.invoke(
+            cli, ["compose", "create", "--repo", "repo", "--base", "config",
+                  "--treefile", "treefile.yaml", "a", "b"])
+        assert result.exit_code == 2
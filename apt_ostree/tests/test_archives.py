@@ -0,0 +1,176 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import types
+from unittest import mock
+
+import fixtures
+
+from apt_ostree.archives import ArchiveCache
+from apt_ostree.cmd import State
+from apt_ostree.tests import base
+
+
+def _version(name, content, version="1.0"):
+    return types.SimpleNamespace(
+        package=types.SimpleNamespace(shortname=name, name=name),
+        version=version,
+        architecture="amd64",
+        size=len(content),
+        sha256=hashlib.sha256(content).hexdigest(),
+        uris=[],
+    )
+
+
+def _change(version):
+    return types.SimpleNamespace(
+        candidate=version, marked_install=True, marked_upgrade=False,
+        marked_downgrade=False)
+
+
+class TestArchiveCache(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = tmp.joinpath("workspace")
+        self.cache = self.open_cache()
+
+    def open_cache(self):
+        cache = ArchiveCache(self.state)
+        self.addCleanup(cache.close)
+        return cache
+
+    def add_object(self, version, content):
+        self.cache.object_path(version.sha256).write_bytes(content)
+
+    def test_verify(self):
+        version = _version("foo", b"foo")
+        path = self.cache.cachedir.joinpath("foo.deb")
+        path.write_bytes(b"foo")
+        assert self.cache._verify(path, version)
+        path.write_bytes(b"bar")
+        assert not self.cache._verify(path, version)
+        path.write_bytes(b"foobar")
+        assert not self.cache._verify(path, version)
+
+    def test_link_rebuilt_package(self):
+        old = _version("foo", b"old")
+        new = _version("foo", b"new")
+        self.add_object(old, b"old")
+        self.add_object(new, b"new")
+        name = self.cache.cachedir.joinpath(self.cache.archive_name(old))
+        assert self.cache.link(old)
+        assert name.read_bytes() == b"old"
+        # Same name and version, different content.
+        assert self.cache.link(new)
+        assert name.read_bytes() == b"new"
+        assert not self.cache.link(_version("bar", b"bar"))
+
+    def test_record(self):
+        hit = _version("hit", b"hit")
+        self.add_object(hit, b"hit")
+        self.cache.link(hit)
+        before = self.cache.snapshot()
+
+        # An archive apt downloaded itself.
+        miss = _version("miss", b"miss")
+        self.cache.cachedir.joinpath(
+            self.cache.archive_name(miss)).write_bytes(b"miss")
+        self.cache.record(before, [_change(hit), _change(miss)])
+
+        assert self.cache.object_path(miss.sha256).exists()
+        with open(self.cache.stats_file) as f:
+            assert json.load(f) == {"hits": 1, "misses": 1, "hit_bytes": 3}
+
+    def test_prefetch_then_install(self):
+        hit = _version("hit", b"hit")
+        self.add_object(hit, b"hit")
+        miss = _version("miss", b"miss")
+        changes = [_change(hit), _change(miss)]
+
+        def download(version):
+            self.add_object(version, b"miss")
+
+        with mock.patch.object(self.cache, "_download",
+                               side_effect=download):
+            assert self.cache.prefetch(changes)
+        # apt runs offline after the prefetch.
+        self.cache.record(self.cache.snapshot(), changes)
+        with open(self.cache.stats_file) as f:
+            assert json.load(f) == {"hits": 1, "misses": 1, "hit_bytes": 3}
+
+    def test_record_concurrent_evict(self):
+        hit = _version("hit", b"hit")
+        self.add_object(hit, b"hit")
+        self.cache.link(hit)
+        before = self.cache.snapshot()
+        self.cache.cachedir.joinpath(self.cache.archive_name(hit)).unlink()
+        self.cache.record(before, [_change(hit)])
+
+    def test_evict(self):
+        old = _version("old", b"old")
+        new = _version("new", b"new")
+        for version, content, mtime in [(old, b"old", 1), (new, b"new", 2)]:
+            self.add_object(version, content)
+            self.cache.link(version)
+            os.utime(self.cache.object_path(version.sha256), (mtime, mtime))
+        self.cache.max_size = 3
+        self.cache.evict()
+        assert not self.cache.object_path(old.sha256).exists()
+        assert not self.cache.cachedir.joinpath(
+            self.cache.archive_name(old)).exists()
+        assert self.cache.object_path(new.sha256).exists()
+
+    def test_evict_keeps_new_downloads(self):
+        name = self.cache.cachedir.joinpath("foo_1.0_amd64.deb")
+        name.write_bytes(b"foo")
+        self.cache.max_size = 0
+        self.cache.evict()
+        assert name.exists()
+
+    def test_concurrent_runs(self):
+        stored = _version("stored", b"stored")
+        self.add_object(stored, b"stored")
+        self.cache.link(stored)
+        other = self.open_cache()
+        assert other.cachedir != self.cache.cachedir
+        # New runs start with every stored archive.
+        name = self.cache.archive_name(stored)
+        assert other.cachedir.joinpath(name).read_bytes() == b"stored"
+
+        # Both runs download the same package while they overlap.
+        miss = _version("miss", b"miss")
+        before = self.cache.snapshot()
+        other_before = other.snapshot()
+        for cache in [self.cache, other]:
+            cache.cachedir.joinpath(
+                cache.archive_name(miss)).write_bytes(b"miss")
+        self.cache.max_size = 4
+        self.cache.record(before, [_change(miss)])
+        other.record(other_before, [_change(miss)])
+
+        # The first run evicted the archive the other one still uses.
+        assert not self.cache.object_path(stored.sha256).exists()
+        assert not self.cache.names.joinpath(name).exists()
+        assert other.cachedir.joinpath(name).read_bytes() == b"stored"
+        assert self.cache.object_path(miss.sha256).read_bytes() == b"miss"
+        with open(self.cache.stats_file) as f:
+            assert json.load(f)["misses"] == 2
+
+    def test_remove_stale(self):
+        crashed = ArchiveCache(self.state)
+        # The lock is released when the process exits.
+        os.close(crashed._lock)
+        self.open_cache()
+        assert not crashed.cachedir.exists()
+        assert self.cache.cachedir.exists()
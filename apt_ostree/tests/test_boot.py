@@ -0,0 +1,71 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import hashlib
+import pathlib
+
+import fixtures
+
+from apt_ostree.boot import Boot
+from apt_ostree.cmd import State
+from apt_ostree.tests import base
+
+
+class TestBoot(base.TestCase):
+
+    def setUp(self):
+        super(TestBoot, self).setUp()
+        self.tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.bootdir = self.tmp.joinpath("boot")
+        self.bootdir.mkdir()
+        self.targetdir = self.tmp.joinpath("ostree-boot")
+        for version in ["6.1.0-amd64", "6.1.0-rt-amd64"]:
+            self.bootdir.joinpath(f"vmlinuz-{version}").write_bytes(b"kx")
+            self.bootdir.joinpath(f"initrd.img-{version}").write_text(
+                version)
+            self.bootdir.joinpath(f"config-{version}").write_text(version)
+
+    def boot_pairs(self):
+        kernels = [p.name for p in self.targetdir.glob("vmlinuz-*")]
+        initramfs = [p.name for p in self.targetdir.glob("initramfs-*")]
+        assert len(kernels) == 1
+        assert len(initramfs) == 1
+        assert kernels[0][len("vmlinuz-"):] == \
+            initramfs[0][len("initramfs-"):]
+        return kernels[0]
+
+    def test_setup_boot_multiple_kernels(self):
+        csums = Boot(State()).setup_boot(self.bootdir, self.targetdir)
+
+        assert sorted(csums) == ["6.1.0-amd64", "6.1.0-rt-amd64"]
+        csum = hashlib.sha256(b"kx" + b"6.1.0-amd64").hexdigest()
+        assert csums["6.1.0-amd64"] == csum
+        rt = csums["6.1.0-rt-amd64"]
+        assert self.boot_pairs() == f"vmlinuz-6.1.0-rt-amd64-{rt}"
+        setdir = self.tmp.joinpath("modules/6.1.0-amd64")
+        assert setdir.joinpath(f"vmlinuz-6.1.0-amd64-{csum}").exists()
+        assert setdir.joinpath(f"initramfs-6.1.0-amd64-{csum}").exists()
+        assert self.targetdir.joinpath("config-6.1.0-rt-amd64").exists()
+        assert list(self.bootdir.iterdir()) == []
+
+    def test_setup_boot_default_kernel(self):
+        state = State()
+        state.default_kernel = "6.1.0-amd64"
+        csums = Boot(state).setup_boot(self.bootdir, self.targetdir)
+
+        csum = csums["6.1.0-amd64"]
+        assert self.boot_pairs() == f"vmlinuz-6.1.0-amd64-{csum}"
+        rt = csums["6.1.0-rt-amd64"]
+        setdir = self.tmp.joinpath("modules/6.1.0-rt-amd64")
+        assert setdir.joinpath(f"vmlinuz-6.1.0-rt-amd64-{rt}").exists()
+
+        # Switching the default swaps the sets.
+        state.default_kernel = "6.1.0-rt-amd64"
+        Boot(state).select_default(self.targetdir)
+        assert self.boot_pairs() == f"vmlinuz-6.1.0-rt-amd64-{rt}"
+        setdir = self.tmp.joinpath("modules/6.1.0-amd64")
+        assert setdir.joinpath(f"initramfs-6.1.0-amd64-{csum}").exists()
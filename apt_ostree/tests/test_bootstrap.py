@@ -0,0 +1,119 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import pathlib
+from unittest import mock
+
+import fixtures
+
+from apt_ostree.archives import ArchiveCache
+from apt_ostree.bootstrap import Bootstrap
+from apt_ostree.cmd import State
+from apt_ostree.tests import base
+
+
+class TestBootstrapReuse(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = tmp.joinpath("workspace")
+        self.state.base = tmp.joinpath("config")
+        self.state.branch = "debian/bookworm"
+        self.bootstrap = Bootstrap(self.state)
+        self.bootstrap.cache = mock.Mock()
+        self.bootstrap.cache.lookup.return_value = "cached"
+        self.bootstrap.ostree = mock.Mock()
+        self.bootstrap.ostree.has_commit.return_value = True
+        self.bootstrap.ostree.ref_bindings.return_value = ["debian/bookworm"]
+        self.repo = self.bootstrap.ostree.open_ostree.return_value
+
+    def test_new_branch(self):
+        self.repo.resolve_rev.return_value = (True, None)
+        assert self.bootstrap.reuse("key")
+        self.bootstrap.ostree.set_ref.assert_called_once_with(
+            "debian/bookworm", "cached")
+
+    def test_up_to_date(self):
+        self.repo.resolve_rev.return_value = (True, "cached")
+        assert self.bootstrap.reuse("key")
+        self.bootstrap.ostree.set_ref.assert_not_called()
+
+    def test_branch_moved_on(self):
+        self.repo.resolve_rev.return_value = (True, "newer")
+        assert not self.bootstrap.reuse("key")
+        self.bootstrap.ostree.set_ref.assert_not_called()
+
+    def test_other_branch(self):
+        self.repo.resolve_rev.return_value = (True, None)
+        self.bootstrap.ostree.ref_bindings.return_value = ["starlingx"]
+        assert not self.bootstrap.reuse("key")
+        self.bootstrap.ostree.set_ref.assert_not_called()
+
+
+class TestApplyPackages(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = tmp.joinpath("workspace")
+        self.bootstrap = Bootstrap(self.state)
+
+        # A staged tree, with /var linked to usr/rootdirs/var.
+        self.rootfs = tmp.joinpath("rootfs")
+        self.rootfs.joinpath("usr/rootdirs/var/lib/foo").mkdir(parents=True)
+        self.rootfs.joinpath("usr/rootdirs/var/lib/foo/data").write_text(
+            "data\n")
+        self.rootfs.joinpath("usr/share/foo").mkdir(parents=True)
+        self.rootfs.joinpath("usr/share/foo/data").symlink_to(
+            "/var/lib/foo/data")
+        self.rootfs.joinpath("var").symlink_to("usr/rootdirs/var")
+
+    def test_sanitize_staged_tree(self):
+        rewritten = self.bootstrap.sanitize_usr_symlinks(self.rootfs)
+        assert rewritten == [("usr/share/foo/data", "var/lib/foo/data")]
+        link = self.rootfs.joinpath("usr/share/foo/data")
+        assert not link.is_symlink()
+        assert link.read_text() == "data\n"
+
+    @mock.patch("apt_ostree.bootstrap.Apt")
+    def test_apply_packages_sanitizes(self, apt):
+        apt.return_value.cache.return_value.__contains__.return_value = True
+        apt.return_value.archives.prefetch.return_value = True
+        with mock.patch.object(self.bootstrap, "create_tmpfile_dir"):
+            self.bootstrap.apply_packages(self.rootfs, ["foo"], [])
+        assert not self.rootfs.joinpath("usr/share/foo/data").is_symlink()
+
+
+class TestArchiveHooks(base.TestCase):
+
+    CLEANUP = ('rm -rf "$1"/var/cache/apt/archives/*.deb '
+               '"$1"/var/cache/apt/archives/partial/*')
+
+    def setUp(self):
+        super().setUp()
+        tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = tmp.joinpath("workspace")
+        self.bootstrap = Bootstrap(self.state)
+
+    def test_cleanup_hook(self):
+        args = self.bootstrap.archive_hooks(ArchiveCache(self.state))
+        assert args[-2] == "--customize-hook"
+        assert self.CLEANUP in args[-1]
+        # Only run once the shared cache is unmounted.
+        assert args[-4] == "--customize-hook"
+        assert "umount" in args[-3]
+        assert not any("sync-in" in arg for arg in args)
+
+    def test_cleanup_hook_without_cache(self):
+        self.state.archive_cache_size = 0
+        args = self.bootstrap.archive_hooks(ArchiveCache(self.state))
+        assert args[0] == "--customize-hook"
+        assert self.CLEANUP in args[1]
@@ -0,0 +1,51 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import pathlib
+
+import fixtures
+
+from apt_ostree.bootstrap_cache import BootstrapCache
+from apt_ostree.cmd import State
+from apt_ostree.tests import base
+
+
+class TestBootstrapCache(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = tmp.joinpath("workspace")
+        self.state.base = tmp.joinpath("config")
+        self.state.base.joinpath("overlay/debian/etc/apt").mkdir(
+            parents=True)
+        self.cache = BootstrapCache(self.state)
+
+    def test_hook_paths(self):
+        mmdebstrap = {
+            "setup-hooks": ["sync-in overlay/debian/ /"],
+            "customize-hooks": ["echo 'root:root' | chroot \"$1\" chpasswd"],
+        }
+        assert self.cache._hook_paths(mmdebstrap) == [
+            self.state.base.joinpath("overlay/debian")]
+
+    def test_release_urls(self):
+        self.state.base.joinpath(
+            "overlay/debian/etc/apt/sources.list").write_text(
+            "deb [trusted=yes] http://mirror/stx ./\n"
+            "deb-src http://deb.debian.org/debian bullseye main\n")
+        paths = [self.state.base.joinpath("overlay/debian")]
+        assert self.cache._release_urls({"suite": "bullseye"}, paths) == [
+            "http://mirror/stx/./"]
+        assert self.cache._release_urls({"suite": "bookworm"}, []) == [
+            "http://deb.debian.org/debian/dists/bookworm/"]
+
+    def test_store_lookup(self):
+        assert self.cache.lookup("key") is None
+        self.cache.store("key", "abc")
+        assert self.cache.lookup("key") == "abc"
@@ -26,3 +26,9 @@ class TestAPTCLI(base.TestCase):
         runner = CliRunner()
         result = runner.invoke(cli, ["--debug", "version"])
         assert result.exit_code == 0
+
+    def test_rebase_fetch_options(self):
+        runner = CliRunner()
+        result = runner.invoke(cli, ["rebase", "--help"])
+        assert result.exit_code == 0
+        assert "--depth" in result.output
@@ -0,0 +1,89 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import pathlib
+
+import fixtures
+
+from apt_ostree import dpkg
+from apt_ostree.tests import base
+
+STATUS = b"""Package: bash
+Status: install ok installed
+Version: 5.2.15-2+b2
+Description: GNU Bourne Again SHell
+ Bash is an sh-compatible command language interpreter.
+
+Package: nano
+Status: deinstall ok config-files
+Version: 7.2-1
+
+Package: vim
+Status: install ok installed
+Version: 2:9.0.1378-2
+Architecture: amd64
+Installed-Size: 3912
+"""
+
+EXTENDED_STATES = b"""Package: vim
+Architecture: amd64
+Auto-Installed: 1
+"""
+
+
+class TestDpkgStatus(base.TestCase):
+
+    def test_parse_status_chunks(self):
+        chunks = [STATUS[i:i + 7] for i in range(0, len(STATUS), 7)]
+        stanzas = list(dpkg.parse_status(chunks))
+        assert len(stanzas) == 3
+        assert stanzas[2]["Version"] == "2:9.0.1378-2"
+        assert stanzas[0]["Description"].endswith("interpreter.")
+
+    def test_installed_packages(self):
+        stanzas = dpkg.parse_status([STATUS])
+        assert dpkg.installed_packages(stanzas) == {"bash", "vim"}
+
+    def test_manifest(self):
+        rootfs = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        var = rootfs.joinpath("usr/rootdirs/var")
+        var.joinpath("lib/dpkg").mkdir(parents=True)
+        var.joinpath("lib/apt").mkdir(parents=True)
+        var.joinpath("lib/dpkg/status").write_bytes(STATUS)
+        var.joinpath("lib/apt/extended_states").write_bytes(EXTENDED_STATES)
+
+        manifest = dpkg.manifest(rootfs)
+        assert [pkg[0] for pkg in manifest] == ["bash", "vim"]
+        assert manifest[1] == ("vim", "2:9.0.1378-2", "amd64", False, 3912)
+
+    def test_diff_manifests(self):
+        old = [("bash", "5.2.15-2", "amd64", True, 7000),
+               ("nano", "7.2-1", "amd64", True, 2000),
+               ("vim", "2:9.0.1378-2", "amd64", True, 3900)]
+        new = [("bash", "5.2.15-2+b2", "amd64", True, 7010),
+               ("curl", "7.88.1-10", "amd64", True, 500),
+               ("vim", "2:9.0.1378-1", "amd64", True, 3900)]
+        diff = dpkg.diff_manifests(old, new)
+        assert [p["name"] for p in diff["added"]] == ["curl"]
+        assert [p["name"] for p in diff["removed"]] == ["nano"]
+        assert [p["name"] for p in diff["upgraded"]] == ["bash"]
+        assert [p["name"] for p in diff["downgraded"]] == ["vim"]
+        assert diff["size_delta"] == 10 + 500 - 2000
+
+    def test_file_lists(self):
+        rootfs = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        info = rootfs.joinpath(dpkg.INFO)
+        info.mkdir(parents=True)
+        info.joinpath("bash.list").write_text("/.\n/usr/bin/bash\n")
+        info.joinpath("libc6:amd64.list").write_text("/var\n/var/lib/x\n")
+        info.joinpath("bash.md5sums").write_text("abc  usr/bin/bash\n")
+
+        assert sorted(dpkg.file_lists(rootfs)) == [
+            ("bash", "/."), ("bash", "/usr/bin/bash"),
+            ("libc6", "/var"), ("libc6", "/var/lib/x")]
+        assert list(dpkg.file_lists(rootfs, ["libc6:amd64"])) == [
+            ("libc6", "/var"), ("libc6", "/var/lib/x")]
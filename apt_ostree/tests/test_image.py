@@ -0,0 +1,46 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import pathlib
+
+import fixtures
+
+from apt_ostree.cmd import State
+from apt_ostree.image import Image
+from apt_ostree.tests import base
+
+
+class TestImage(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.src = tmp.joinpath("template")
+        self.src.joinpath("scripts").mkdir(parents=True)
+        self.src.joinpath("image.yaml").write_text("recipe\n")
+        self.src.joinpath("scripts/setup.sh").write_text("true\n")
+        self.dst = tmp.joinpath("image")
+        self.dst.mkdir()
+        self.image = Image(State())
+
+    def test_sync_template(self):
+        assert self.image.sync_template(self.src, self.dst) == 2
+        assert self.dst.joinpath("scripts/setup.sh").read_text() == "true\n"
+        # Nothing changed.
+        assert self.image.sync_template(self.src, self.dst) == 0
+
+        self.src.joinpath("image.yaml").write_text("new recipe\n")
+        assert self.image.sync_template(self.src, self.dst) == 1
+        assert self.dst.joinpath("image.yaml").read_text() == "new recipe\n"
+
+    def test_sync_template_removed(self):
+        self.image.sync_template(self.src, self.dst)
+        self.dst.joinpath("disk.img").write_text("image\n")
+        self.src.joinpath("scripts/setup.sh").unlink()
+        self.image.sync_template(self.src, self.dst)
+        assert not self.dst.joinpath("scripts/setup.sh").exists()
+        assert self.dst.joinpath("disk.img").exists()
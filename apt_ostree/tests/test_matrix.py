@@ -0,0 +1,42 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import pathlib
+
+import fixtures
+
+from apt_ostree.cmd import State
+from apt_ostree.matrix import BuildMatrix
+from apt_ostree.tests import base
+
+
+class TestBuildMatrix(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = tmp.joinpath("workspace")
+        self.state.base = tmp.joinpath("config")
+        for branch in ["debian/bookworm", "debian/bullseye", "starlingx"]:
+            path = self.state.base.joinpath(branch)
+            path.mkdir(parents=True)
+            path.joinpath("bootstrap.yaml").write_text("---\n")
+        self.state.base.joinpath("debian/bookworm/image").mkdir()
+
+    def test_find_branches(self):
+        assert BuildMatrix(self.state).find_branches() == [
+            "debian/bookworm", "debian/bullseye", "starlingx"]
+
+    def test_branch_state(self):
+        state = BuildMatrix(self.state)._branch_state("debian/bookworm")
+        assert state.branch == "debian/bookworm"
+        assert state.base == self.state.base.joinpath("debian/bookworm")
+        assert state.workspace == self.state.workspace.joinpath(
+            "branches/debian_bookworm")
+        assert state.cache_dir == self.state.workspace.joinpath("cache")
+        assert self.state.branch is None
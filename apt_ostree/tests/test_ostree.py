@@ -0,0 +1,170 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import os
+import pathlib
+import stat
+
+import fixtures
+
+from apt_ostree.cmd import State
+from apt_ostree.ostree import _overlay_filter
+from apt_ostree.ostree import Gio
+from apt_ostree.ostree import Ostree
+from apt_ostree.ostree import OSTree
+from apt_ostree.tests import base
+
+
+class TestCheckoutRepo(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        if os.getuid() != 0:
+            self.skipTest("bare repositories need root")
+        self.tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = self.tmp.joinpath("workspace")
+        self.state.repo = self.tmp.joinpath("repo")
+        self.ostree = Ostree(self.state)
+        self.ostree.init()
+
+        tree = self.tmp.joinpath("tree")
+        tree.joinpath("usr/bin").mkdir(parents=True)
+        tree.joinpath("usr/bin/tool").write_text("tool\n")
+        self.ostree.ostree_commit(root=str(tree), repo=self.state.repo,
+                                  branch="test", subject="test", msg="test")
+
+    def checkout(self, name, copy):
+        rootfs = self.tmp.joinpath(name)
+        repo = self.ostree.open_checkout_repo("test")
+        self.ostree.ostree_checkout("test", rootfs, repo=repo, copy=copy)
+        return rootfs
+
+    def test_copy(self):
+        rootfs = self.checkout("a", copy=True)
+        tool = rootfs.joinpath("usr/bin/tool")
+        assert tool.stat().st_nlink == 1
+        with open(tool, "a") as f:
+            f.write("appended\n")
+
+        # The repository still holds the original content.
+        other = self.checkout("b", copy=True)
+        assert other.joinpath("usr/bin/tool").read_text() == "tool\n"
+
+    def test_hardlink(self):
+        rootfs = self.checkout("a", copy=False)
+        assert rootfs.joinpath("usr/bin/tool").stat().st_nlink > 1
+
+
+class TestOverlayCommit(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = self.tmp.joinpath("workspace")
+        self.state.repo = self.tmp.joinpath("repo")
+        self.ostree = Ostree(self.state)
+
+    def test_overlay_filter(self):
+        info = Gio.FileInfo.new()
+        info.set_file_type(Gio.FileType.SPECIAL)
+        info.set_attribute_uint32("unix::rdev", 0)
+        assert _overlay_filter(None, "/f", info) == \
+            OSTree.RepoCommitFilterResult.SKIP
+        info.set_file_type(Gio.FileType.REGULAR)
+        assert _overlay_filter(None, "/f", info) == \
+            OSTree.RepoCommitFilterResult.ALLOW
+
+    def test_whiteouts(self):
+        if os.getuid() != 0:
+            self.skipTest("whiteouts need root")
+        self.ostree.init()
+        tree = self.tmp.joinpath("tree")
+        for d in ["opaque", "merged", "replaced"]:
+            tree.joinpath(d).mkdir(parents=True)
+            tree.joinpath(d, "old").write_text("old\n")
+        tree.joinpath("removed").write_text("removed\n")
+        stats = self.ostree.ostree_commit(
+            root=str(tree), repo=self.state.repo, branch="test",
+            subject="test", msg="test")
+
+        upper = self.tmp.joinpath("upper")
+        upper.joinpath("opaque").mkdir(parents=True)
+        upper.joinpath("opaque/new").write_text("new\n")
+        os.setxattr(upper.joinpath("opaque"), "trusted.overlay.opaque", b"y")
+        upper.joinpath("merged").mkdir()
+        os.mknod(upper.joinpath("merged/old"), stat.S_IFCHR, 0)
+        os.mknod(upper.joinpath("removed"), stat.S_IFCHR, 0)
+        upper.joinpath("replaced").write_text("file\n")
+        self.ostree.ostree_commit_overlay(
+            upper, stats["commit"], "test", subject="test", msg="test")
+
+        _, root, _ = self.ostree.open_ostree().read_commit("test", None)
+
+        def exists(path):
+            return root.resolve_relative_path(path).query_exists(None)
+
+        assert not exists("removed")
+        assert not exists("opaque/old")
+        assert exists("opaque/new")
+        assert exists("merged")
+        assert not exists("merged/old")
+        assert root.resolve_relative_path("replaced").query_file_type(
+            Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, None) == \
+            Gio.FileType.REGULAR
+
+
+class TestCommit(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = self.tmp.joinpath("workspace")
+        self.state.repo = self.tmp.joinpath("repo")
+        self.ostree = Ostree(self.state)
+        self.tree = self.tmp.joinpath("tree")
+        self.tree.joinpath("usr").mkdir(parents=True)
+
+    def test_ref_binding(self):
+        self.ostree.init()
+        stats = self.ostree.ostree_commit(
+            root=str(self.tree), repo=self.state.repo, branch="test",
+            subject="test", msg="test")
+        assert self.ostree.read_metadata(
+            stats["commit"], OSTree.COMMIT_META_KEY_REF_BINDING) == ["test"]
+
+    def test_lock_target_repo(self):
+        other = self.tmp.joinpath("other")
+        OSTree.Repo.new(Gio.File.new_for_path(str(other))).create(
+            OSTree.RepoMode.ARCHIVE_Z2)
+        self.ostree.ostree_commit(
+            root=str(self.tree), repo=other, branch="test",
+            subject="test", msg="test")
+        assert other.joinpath(".apt-ostree.lock").exists()
+        assert not self.state.repo.exists()
+
+    def test_commit_from(self):
+        self.ostree.init()
+        head = self.ostree.ostree_commit(
+            root=str(self.tree), repo=self.state.repo, branch="test",
+            subject="test", msg="test")["commit"]
+        self.tree.joinpath("usr/new").write_text("new\n")
+        stage = self.ostree.ostree_commit(
+            root=str(self.tree), repo=self.state.repo, branch="stage",
+            subject="stage", msg="stage",
+            metadata=self.ostree.string_metadata({"key": "value"}))["commit"]
+
+        rev = self.ostree.commit_from(
+            stage, "test", subject="test", msg="test")["commit"]
+        assert self.ostree.resolve_rev("test") == rev
+        assert self.ostree.read_metadata(rev, "key") == "value"
+        assert self.ostree.ref_bindings(rev) == ["test"]
+        repo = self.ostree.open_ostree()
+        _, commit = repo.load_variant(OSTree.ObjectType.COMMIT, rev)
+        assert OSTree.commit_get_parent(commit) == head
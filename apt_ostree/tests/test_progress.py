@@ -0,0 +1,33 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+from unittest import mock
+
+from apt_ostree.cmd import State
+from apt_ostree.progress import PullProgress
+from apt_ostree.tests import base
+
+
+class TestPullProgress(base.TestCase):
+
+    def _async_progress(self):
+        p = mock.Mock()
+        p.get_status.return_value = None
+        p.get_uint.return_value = 10
+        p.get_uint64.return_value = 4096
+        return p
+
+    def test_throttled(self):
+        state = State()
+        state.progress_format = "json"
+        renderer = PullProgress(state, interval=60)
+        with mock.patch("click.echo") as echo:
+            with renderer:
+                for _ in range(1000):
+                    renderer.changed(self._async_progress())
+        # The first update and the final one on exit.
+        assert echo.call_count == 2
@@ -0,0 +1,122 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import os
+import pathlib
+from unittest import mock
+
+import fixtures
+
+from apt_ostree.cmd import State
+from apt_ostree.staging import MARKER
+from apt_ostree.staging import OverlayCache
+from apt_ostree.staging import StagingCache
+from apt_ostree.tests import base
+
+
+class TestStagingCache(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = self.tmp.joinpath("workspace")
+        self.state.staging_cache_size = 1 << 30
+        self.cache = StagingCache(self.state)
+
+    def make_tree(self, name):
+        rootfs = self.tmp.joinpath(name)
+        rootfs.joinpath("usr/lib").mkdir(parents=True)
+        rootfs.joinpath("usr/lib/libfoo.so").write_bytes(b"\0" * 4096)
+        return rootfs
+
+    def test_disabled(self):
+        self.state.staging_cache_size = 0
+        cache = StagingCache(self.state)
+        assert not cache.enabled()
+        assert cache.lookup("abc") is None
+
+    def test_store_take(self):
+        self.cache.store("abc", self.make_tree("a"))
+        dest = self.tmp.joinpath("dest")
+        assert self.cache.take("abc", dest)
+        assert dest.joinpath("usr/lib/libfoo.so").exists()
+        assert not dest.joinpath(MARKER).exists()
+        # An entry can only be taken once.
+        assert not self.cache.take("abc", self.tmp.joinpath("other"))
+
+    def test_incomplete_entry(self):
+        self.cache.store("abc", self.make_tree("a"))
+        self.cache.cachedir.joinpath("abc/rootfs", MARKER).unlink()
+        assert self.cache.lookup("abc") is None
+        assert not self.cache.cachedir.joinpath("abc").exists()
+
+    def test_take_concurrently_removed(self):
+        self.cache.store("abc", self.make_tree("a"))
+        dest = self.tmp.joinpath("dest")
+        rename = os.rename
+
+        def take_first(src, dst):
+            if dst == dest:
+                # Another process took the tree first.
+                raise FileNotFoundError(2, os.strerror(2))
+            rename(src, dst)
+
+        with mock.patch("os.rename", side_effect=take_first):
+            assert not self.cache.take("abc", dest)
+
+    def test_evict(self):
+        self.cache.store("old", self.make_tree("a"))
+        size = self.cache._load_info(
+            self.cache.cachedir.joinpath("old"))["size"]
+        self.cache.max_size = size
+        self.cache.store("new", self.make_tree("b"))
+        assert not self.cache.cachedir.joinpath("old").exists()
+        assert self.cache.lookup("new") is not None
+
+
+class TestOverlayCache(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = tmp.joinpath("workspace")
+        self.state.staging = "overlay"
+        self.cache = OverlayCache(self.state)
+        self.upper = tmp.joinpath("upper")
+
+    def add_base(self, rev):
+        self.cache.layer_path(rev).mkdir(parents=True)
+
+    def add_layer(self, rev, parent):
+        self.upper.mkdir()
+        self.cache.add_layer(rev, parent, self.upper)
+
+    def test_lowerdirs(self):
+        self.add_base("a")
+        self.add_layer("b", "a")
+        self.add_layer("c", "b")
+        assert self.cache.lowerdirs("c") == [
+            self.cache.layer_path(rev) for rev in ["c", "b", "a"]]
+        assert self.cache.lowerdirs("d") is None
+
+    def test_max_layers(self):
+        self.add_base("0")
+        for i in range(1, OverlayCache.MAX_LAYERS + 1):
+            self.add_layer(str(i), str(i - 1))
+        assert self.cache.lowerdirs(str(OverlayCache.MAX_LAYERS)) is None
+        assert not self.upper.exists()
+
+    def test_prune(self):
+        self.add_base("a")
+        self.add_layer("b", "a")
+        self.add_layer("c", "b")
+        self.add_base("x")
+        self.cache.prune(["b"])
+        assert sorted(e.name for e in self.cache.cachedir.iterdir()) == [
+            "a", "b"]
@@ -0,0 +1,75 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import pathlib
+
+import fixtures
+
+from apt_ostree.cmd import State
+from apt_ostree.tests import base
+from apt_ostree.treefile import copy_overlay
+from apt_ostree.treefile import Treefile
+
+
+class TestTreefile(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.state = State()
+        self.state.workspace = self.tmp.joinpath("workspace")
+        self.state.base = self.tmp.joinpath("config")
+        self.state.base.mkdir()
+        self.treefile = Treefile(self.state)
+
+    def test_stages(self):
+        path = self.state.base.joinpath("treefile.yaml")
+        path.write_text(
+            "layers:\n"
+            "  - [vim, less]\n"
+            "  - [openssh-server]\n"
+            "remove:\n"
+            "  - usr/share/doc/*\n")
+        stages = self.treefile.stages(self.treefile.load(path))
+        assert [s["kind"] for s in stages] == [
+            "bootstrap", "layer", "layer", "remove"]
+        assert stages[0]["config"] == "bootstrap.yaml"
+        assert stages[1]["packages"] == ["less", "vim"]
+
+    def test_stage_key(self):
+        stage = {"kind": "layer", "packages": ["vim"]}
+        key, cacheable = self.treefile.stage_key("a", stage)
+        assert cacheable
+        assert self.treefile.stage_key("a", stage)[0] == key
+        assert self.treefile.stage_key("b", stage)[0] != key
+        assert self.treefile.stage_key(
+            "a", {"kind": "layer", "packages": ["less"]})[0] != key
+
+    def test_overlay_key(self):
+        overlay = self.state.base.joinpath("overlay/etc")
+        overlay.mkdir(parents=True)
+        overlay.joinpath("motd").write_text("hello\n")
+        stage = {"kind": "overlays", "overlays": ["overlay"]}
+        key, _ = self.treefile.stage_key("", stage)
+        overlay.joinpath("motd").write_text("world\n")
+        assert self.treefile.stage_key("", stage)[0] != key
+
+    def test_copy_overlay(self):
+        overlay = self.tmp.joinpath("overlay")
+        overlay.joinpath("usr/etc").mkdir(parents=True)
+        overlay.joinpath("usr/etc/motd").write_text("hello\n")
+        rootfs = self.tmp.joinpath("rootfs")
+        rootfs.joinpath("usr/etc").mkdir(parents=True)
+        motd = rootfs.joinpath("usr/etc/motd")
+        motd.write_text("old\n")
+        # Stands in for a file hardlinked to the repository.
+        obj = self.tmp.joinpath("object")
+        obj.hardlink_to(motd)
+
+        copy_overlay(overlay, rootfs)
+        assert motd.read_text() == "hello\n"
+        assert obj.read_text() == "old\n"
@@ -0,0 +1,63 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import errno
+import os
+import pathlib
+import subprocess
+from unittest import mock
+
+import fixtures
+
+from apt_ostree.tests import base
+from apt_ostree.utils import move_tree
+from apt_ostree.utils import parse_size
+
+
+class TestUtils(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = pathlib.Path(self.useFixture(fixtures.TempDir()).path)
+        self.src = self.tmp.joinpath("src")
+        self.src.joinpath("sub").mkdir(parents=True)
+        self.src.joinpath("sub/file").write_text("data\n")
+
+    def test_parse_size(self):
+        assert parse_size("512M") == 512 << 20
+        assert parse_size("1024") == 1024
+
+    def test_move_tree(self):
+        dst = self.tmp.joinpath("dst")
+        move_tree(self.src, dst)
+        assert dst.joinpath("sub/file").read_text() == "data\n"
+        assert not self.src.exists()
+
+    def test_move_tree_exdev(self):
+        dst = self.tmp.joinpath("dst")
+        error = OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        with mock.patch("os.rename", side_effect=error):
+            move_tree(self.src, dst)
+        assert dst.joinpath("sub/file").read_text() == "data\n"
+        assert not self.src.exists()
+
+    def test_move_tree_copy_fails(self):
+        dst = self.tmp.joinpath("dst")
+        error = OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        failed = subprocess.CalledProcessError(1, "cp")
+
+        def copy(*args, **kwargs):
+            # A partial copy before running out of space.
+            dst.mkdir()
+            raise failed
+
+        with mock.patch("os.rename", side_effect=error), \
+                mock.patch("subprocess.run", side_effect=copy):
+            self.assertRaises(subprocess.CalledProcessError,
+                              move_tree, self.src, dst)
+        assert self.src.joinpath("sub/file").read_text() == "data\n"
+        assert not dst.exists()
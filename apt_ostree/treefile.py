@@ -0,0 +1,339 @@
+"""
+Copyright (c) 2023 Wind River Systems, Inc.
+
+SPDX-License-Identifier: Apache-2.0
+
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+
+from rich.console import Console
+from rich.table import Table
+import yaml
+
+from apt_ostree.bootstrap import Bootstrap
+from apt_ostree.bootstrap_cache import BootstrapCache
+from apt_ostree.constants import VERSION
+from apt_ostree.deploy import Deploy
+from apt_ostree.ostree import Ostree
+from apt_ostree.utils import run_sandbox_command
+
+# Keys of a treefile, in the order their stages run.
+STAGES = ["bootstrap", "feeds", "layers", "overlays", "remove",
+          "postprocess"]
+
+# Ref of the commit holding the result of a stage.
+STAGE_REF = "apt-ostree/stages/{key}"
+
+# Commit metadata holding the key of the last stage of a branch commit.
+STAGE_KEY = "apt-ostree.treefile.stage"
+
+# Sources list written by the feeds stage.
+FEEDS_LIST = "etc/apt/sources.list.d/apt-ostree-treefile.list"
+
+
+class Treefile:
+    """Compose a branch from a declarative treefile.
+
+    A treefile is a YAML mapping in the configuration directory:
+
+        bootstrap: bootstrap.yaml
+        feeds:
+          - deb [trusted=yes] http://mirror/starlingx ./
+        layers:
+          - [openssh-server]
+          - [vim, less]
+        overlays:
+          - overlay/
+        remove:
+          - usr/share/doc/*
+        postprocess:
+          - systemctl enable ssh
+
+    Every entry is a stage that runs on the result of the one before.
+    Its key covers its definition, the files it reads, the Release files
+    of the apt sources it depends on and the key of the previous stage,
+    and its result is committed to apt-ostree/stages/<key>. A re-run
+    starts from the last stage whose key is unchanged. The tree of the
+    last stage is then committed on top of the branch.
+    """
+
+    def __init__(self, state):
+        self.logging = logging.getLogger(__name__)
+        self.console = Console()
+        self.state = state
+        self.ostree = Ostree(self.state)
+        self.cache = BootstrapCache(self.state)
+
+    def load(self, path):
+        """Read and check a treefile."""
+        if not path.exists():
+            self.logging.error(f"{path} does not exist.")
+            sys.exit(1)
+        with open(path, "r") as f:
+            treefile = yaml.safe_load(f) or {}
+        if not isinstance(treefile, dict):
+            self.logging.error(f"{path} is not a mapping.")
+            sys.exit(1)
+
+        unknown = sorted(set(treefile) - set(STAGES))
+        if unknown:
+            self.logging.error(
+                f"Unknown keys in {path.name}: {', '.join(unknown)}")
+            sys.exit(1)
+        treefile.setdefault("bootstrap", "bootstrap.yaml")
+        for key in STAGES[1:]:
+            value = treefile.setdefault(key, [])
+            if not isinstance(value, list):
+                self.logging.error(f"{key} in {path.name} is not a list.")
+                sys.exit(1)
+        for layer in treefile["layers"]:
+            if not isinstance(layer, list):
+                self.logging.error(
+                    f"Layers in {path.name} must be lists of packages.")
+                sys.exit(1)
+        return treefile
+
+    def stages(self, treefile):
+        """List the stages of a treefile in the order they run."""
+        stages = [{"kind": "bootstrap", "config": treefile["bootstrap"]}]
+        if treefile["feeds"]:
+            stages.append({"kind": "feeds", "feeds": treefile["feeds"]})
+        for layer in treefile["layers"]:
+            stages.append({"kind": "layer", "packages": sorted(layer)})
+        if treefile["overlays"]:
+            stages.append({"kind": "overlays",
+                           "overlays": treefile["overlays"]})
+        if treefile["remove"]:
+            stages.append({"kind": "remove", "paths": treefile["remove"]})
+        if treefile["postprocess"]:
+            stages.append({"kind": "postprocess",
+                           "scripts": treefile["postprocess"]})
+        return stages
+
+    def stage_key(self, parent, stage):
+        """Compute the key of a stage following the stage keyed parent.
+
+        Returns the key and whether it can be reused, which is not the
+        case when a Release file could not be fetched.
+        """
+        m = hashlib.sha256()
+        m.update(f"apt-ostree {VERSION}\0{parent}\0".encode("utf-8"))
+        m.update(json.dumps(stage, sort_keys=True).encode("utf-8"))
+
+        digest = ""
+        if stage["kind"] == "bootstrap":
+            digest = self.cache.key(self.state.base.joinpath(
+                stage["config"]))
+        elif stage["kind"] == "feeds":
+            digest = self.cache.sources_digest(stage["feeds"])
+        elif stage["kind"] == "overlays":
+            digest = self.cache.files_digest(
+                [self.state.base.joinpath(p) for p in stage["overlays"]])
+        if digest is None:
+            return m.hexdigest(), False
+        m.update(digest.encode("utf-8"))
+        return m.hexdigest(), True
+
+    def compose(self, path, use_cache=True):
+        """Run the stages of a treefile and commit the result to the branch.
+
+        Stages with a commit for their key are skipped, unless use_cache
+        is False. The branch gets a new commit whose parent is its
+        current head, unless that head was composed from the same stages.
+        """
+        treefile = self.load(path)
+        self.ostree.init()
+
+        plan = []
+        key = ""
+        reusable = use_cache
+        for stage in self.stages(treefile):
+            key, cacheable = self.stage_key(key, stage)
+            reusable = reusable and cacheable
+            if not cacheable:
+                self.logging.warning(
+                    f"Unable to check the sources of the {stage['kind']} "
+                    "stage, running it and the stages after it.")
+            plan.append((stage, key, reusable))
+
+        # Start from the last stage that has a commit for its key.
+        start = 0
+        reuse = None
+        for i in reversed(range(len(plan))):
+            _, key, reusable = plan[i]
+            if reusable:
+                reuse = self.lookup(key)
+            if reuse is not None:
+                start = i
+                break
+
+        results = []
+        for stage, key, _ in plan[start:]:
+            ref = STAGE_REF.format(key=key)
+            if reuse is not None:
+                self.logging.info(
+                    f"Reusing {stage['kind']} stage ({reuse[:10]}).")
+                results.append((stage, ref, reuse, "reused"))
+                reuse = None
+                continue
+            self.logging.info(f"Running {stage['kind']} stage.")
+            rev = self.run_stage(stage, ref, results)
+            results.append((stage, ref, rev, "built"))
+        rev = results[-1][2]
+
+        # The stage commits are not descendants of the branch, so the
+        # result is committed on top of its head.
+        _, current = self.ostree.open_ostree().resolve_rev(
+            self.state.branch, True)
+        if current is not None and plan[-1][2] and \
+           self.ostree.read_metadata(current, STAGE_KEY) == key:
+            self.logging.info(
+                f"{self.state.branch} is up to date ({current[:10]}).")
+            rev = current
+        else:
+            stats = self.ostree.commit_from(
+                rev,
+                self.state.branch,
+                subject="Commit by apt-ostree",
+                msg=f"Composed from {path.name}.",
+                metadata=self.ostree.string_metadata({STAGE_KEY: key}))
+            rev = stats["commit"]
+            self.ostree.update_static_deltas(self.state.branch)
+        self.report(results)
+        return rev
+
+    def lookup(self, key):
+        """Return the commit of the stage with key, or None."""
+        _, rev = self.ostree.open_ostree().resolve_rev(
+            STAGE_REF.format(key=key), True)
+        if rev is None or not self.ostree.has_commit(rev):
+            return None
+        return rev
+
+    def run_stage(self, stage, ref, results):
+        """Run a stage on the result of the previous ones.
+
+        Returns the commit of the stage.
+        """
+        if stage["kind"] == "bootstrap":
+            state = copy.copy(self.state)
+            state.branch = ref
+            return Bootstrap(state).build(
+                self.state.base.joinpath(stage["config"]))
+
+        _, parent, _, _ = results[-1]
+        deploy = Deploy(self.state)
+        rootfs = deploy.get_sysroot(parent)
+        deploy.prestaging(rootfs)
+        if stage["kind"] == "feeds":
+            self.write_feeds(rootfs, stage["feeds"])
+            subject = "Enabled package feeds."
+        elif stage["kind"] == "layer":
+            Bootstrap(self.state).apply_packages(
+                rootfs, stage["packages"], [])
+            subject = f"Installed {', '.join(stage['packages'])}."
+        elif stage["kind"] == "overlays":
+            for overlay in stage["overlays"]:
+                copy_overlay(self.state.base.joinpath(overlay), rootfs)
+            subject = "Copied overlays."
+        elif stage["kind"] == "remove":
+            self.remove_paths(rootfs, stage["paths"])
+            subject = "Removed files."
+        elif stage["kind"] == "postprocess":
+            self.postprocess(rootfs, stage["scripts"])
+            subject = "Ran post-processing scripts."
+        deploy.poststaging(rootfs)
+
+        rev = deploy.commit(
+            rootfs,
+            branch=ref,
+            subject=subject,
+            msg=json.dumps(stage, indent=2, sort_keys=True),
+        )
+        deploy.cleanup(rootfs, rev=rev)
+        return rev
+
+    def write_feeds(self, rootfs, feeds):
+        """Add the feeds to the apt sources of a staged tree."""
+        path = rootfs.joinpath(FEEDS_LIST)
+        # Never write in place, the tree may be hardlinked to the repo.
+        if os.path.lexists(path):
+            os.unlink(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("".join(f"{feed}\n" for feed in feeds))
+
+    def remove_paths(self, rootfs, patterns):
+        """Remove the files matching glob patterns from a staged tree."""
+        for pattern in patterns:
+            matches = sorted(rootfs.glob(pattern.lstrip("/")))
+            if len(matches) == 0:
+                self.logging.warning(f"Nothing matches {pattern}.")
+            for match in matches:
+                if match.is_dir() and not match.is_symlink():
+                    shutil.rmtree(match)
+                else:
+                    os.unlink(match)
+            self.logging.info(f"Removed {len(matches)} paths for {pattern}.")
+
+    def postprocess(self, rootfs, scripts):
+        """Run shell scripts in a staged tree."""
+        for script in scripts:
+            r = run_sandbox_command(["sh", "-e", "-c", script], rootfs,
+                                    check=False)
+            if r.returncode != 0:
+                self.logging.error(f"Post-processing failed: {script}")
+                sys.exit(1)
+
+    def report(self, results):
+        table = Table(box=None)
+        table.add_column("Stage")
+        table.add_column("Key")
+        table.add_column("Commit")
+        table.add_column("Status")
+        for stage, ref, rev, status in results:
+            table.add_row(stage["kind"], ref.rsplit("/", 1)[-1][:10],
+                          rev[:10], status)
+        self.console.print(table)
+
+
+def copy_overlay(src, rootfs):
+    """Copy a directory tree onto a staged tree.
+
+    Existing files are replaced rather than written to, as the tree may
+    be hardlinked to the repository. Paths below /etc and /var follow
+    the symlinks prestaging sets up.
+    """
+    for base, dirs, files in os.walk(src):
+        rel = os.path.relpath(base, src)
+        target = os.path.normpath(os.path.join(rootfs, rel))
+        for name in sorted(dirs):
+            path = os.path.join(base, name)
+            dst = os.path.join(target, name)
+            if os.path.islink(path):
+                files.append(name)
+            elif not os.path.isdir(dst):
+                os.mkdir(dst)
+                shutil.copystat(path, dst)
+                st = os.lstat(path)
+                os.chown(dst, st.st_uid, st.st_gid)
+        for name in sorted(files):
+            path = os.path.join(base, name)
+            dst = os.path.join(target, name)
+            if os.path.lexists(dst):
+                if os.path.isdir(dst) and not os.path.islink(dst):
+                    shutil.rmtree(dst)
+                else:
+                    os.unlink(dst)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), dst)
+            else:
+                shutil.copy2(path, dst)
+            st = os.lstat(path)
+            os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
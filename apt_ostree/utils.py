@@ -5,12 +5,69 @@ SPDX-License-Identifier: Apache-2.0
 
 """
 
+import errno
 import os
+import shutil
 import subprocess
 
 import click
 
 
+def get_cache_dir(state, name):
+    """Return a cache directory in the workspace, creating it if needed.
+
+    Several workspaces can share caches by setting state.cache_dir.
+    """
+    root = state.cache_dir or state.workspace.joinpath("cache")
+    path = root.joinpath(name)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def parse_size(value):
+    """Convert a size such as 512M or 20G to bytes."""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    value = str(value).strip().upper()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def move_tree(src, dst):
+    """Move a file or directory tree to dst, which must not exist.
+
+    Within a filesystem this is a single rename. Across filesystems the
+    tree is copied with cp, which keeps ownership, permissions, xattrs
+    and hardlinks and shares data with reflinks where supported, and
+    the source is only removed once the copy succeeded. If it fails, the
+    partial copy is removed and the error raised.
+    """
+    if os.lstat(src).st_dev == \
+       os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+        try:
+            os.rename(src, dst)
+            return
+        except OSError as e:
+            # Bind mounts of the same device cannot be renamed across.
+            if e.errno != errno.EXDEV:
+                raise
+    try:
+        subprocess.run(["cp", "-a", "--reflink=auto", str(src), str(dst)],
+                       check=True)
+    except (OSError, subprocess.CalledProcessError):
+        _remove(dst)
+        raise
+    _remove(src)
+
+
+def _remove(path):
+    """Remove a file or directory tree if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
 def run_command(cmd,
                 debug=False,
                 stdin=None,
@@ -47,9 +104,14 @@ def run_sandbox_command(
     stdout=None,
     stderr=None,
     check=True,
-    env=None
+    env=None,
+    binds=None
 ):
-    """Run a shell wrapped with bwrap."""
+    """Run a shell wrapped with bwrap.
+
+    binds is a list of extra bwrap mount arguments applied on top of
+    the rootfs.
+    """
     cmd = [
         "bwrap",
         "--proc", "/proc",
@@ -67,6 +129,8 @@ def run_sandbox_command(
         "--die-with-parent",
         "--chdir", "/",
     ]
+    if binds:
+        cmd += binds
     cmd += args
 
     return run_command(